@@ -1,15 +1,18 @@
 # IMPORT PACKAGES AND FUNCTIONS
 import tensorflow as tf
 import numpy      as np
-import os, sys, h5py, pickle, itertools
+import os, sys, pickle, itertools
 from   argparse  import ArgumentParser
 from   tabulate  import tabulate
-from   utils     import get_dataset, validation, make_sample, merge_samples, sample_composition
-from   utils     import compo_matrix, get_sample_weights, get_class_weight, gen_weights, Batch_Generator
+from   utils     import get_dataset, validation, merge_samples, sample_composition
+from   utils     import compo_matrix, get_sample_weights, get_class_weight, Batch_Generator
 from   utils     import cross_valid, valid_results, sample_analysis, feature_removal, feature_ranking
-from   utils     import sample_histograms, fit_scaler, apply_scaler, fit_t_scaler, apply_t_scaler
+from   utils     import sample_histograms, fit_scaler, sketch_scaler, apply_scaler, fit_t_scaler, apply_t_scaler
+from   utils     import load_scaler, scaler_engine, stream_hists, hist_weights, count_sample
+from   utils     import save_weight_table, load_weight_table
+from   utils     import get_manifest, manifest_sample, Sample_Sequence, init_block_cache, batch_dataset, h5_pool
 from   plots_DG  import plot_history, plot_inputs
-from   models    import callback, create_model
+from   models    import callback, create_model, set_scalers, custom_layers
 
 
 # PROGRAM ARGUMENTS
@@ -24,6 +27,9 @@ parser.add_argument( '--n_tracks'       , default =    5,  type = int   )
 parser.add_argument( '--bkg_ratio'      , default =    5,  type = float )
 parser.add_argument( '--n_folds'        , default =    1,  type = int   )
 parser.add_argument( '--n_gpus'         , default =    1,  type = int   )
+parser.add_argument( '--n_tasks'        , default = None,  type = int   )
+parser.add_argument( '--cache_size'     , default =  100,  type = float ) #GB
+parser.add_argument( '--h5_cache'       , default =    4,  type = float ) #GB, HDF5 chunk caches of the datasets read
 parser.add_argument( '--verbose'        , default =    1,  type = int   )
 parser.add_argument( '--patience'       , default =   10,  type = int   )
 parser.add_argument( '--sbatch_var'     , default =    0,  type = int   )
@@ -41,6 +47,13 @@ parser.add_argument( '--scaling'        , default = 'ON'                )
 parser.add_argument( '--t_scaling'      , default = 'OFF'               )
 parser.add_argument( '--plotting'       , default = 'OFF'               )
 parser.add_argument( '--generator'      , default = 'OFF'               )
+parser.add_argument( '--host_dtype'     , default = 'float32'           ) #{float32, float16}
+parser.add_argument( '--cache'          , default = 'OFF'               ) #decoded blocks cache in SLURM_TMPDIR
+parser.add_argument( '--shared'         , default = 'OFF'               ) #samples shared between processes of a node
+parser.add_argument( '--tf_data'        , default = 'OFF'               ) #tf.data pipeline for generator training
+parser.add_argument( '--gen_shuffle'    , default = 'block'             ) #{OFF, ON, block, stream}
+parser.add_argument( '--pack'           , default = 'OFF'               ) #generator batches of exactly batch_size
+parser.add_argument( '--in_graph'       , default = 'OFF'               ) #scaling layers inside the model
 parser.add_argument( '--metrics'        , default = 'val_accuracy'      ) #{loss, val_loss, accuracy, val_accuracy}
 parser.add_argument( '--host_name'      , default = 'lps'               )
 parser.add_argument( '--input_path'     , default = ''                  )
@@ -52,6 +65,8 @@ parser.add_argument( '--scaler_in'      , default = ''                  )
 parser.add_argument( '--scaler_out'     , default = 'scaler.pkl'        )
 parser.add_argument( '--t_scaler_in'    , default = ''                  )
 parser.add_argument( '--t_scaler_out'   , default = 't_scaler.pkl'      )
+parser.add_argument( '--weights_in'     , default = ''                  )
+parser.add_argument( '--weights_out'    , default = 'weights.npz'       )
 parser.add_argument( '--results_in'     , default = ''                  )
 parser.add_argument( '--results_out'    , default = ''                  )
 parser.add_argument( '--feature_removal', default = 'OFF'               )
@@ -64,6 +79,13 @@ for key in ['n_train', 'n_eval', 'n_valid', 'batch_size']: vars(args)[key] = int
 if args.weight_type not in ['bkg_ratio', 'flat', 'match2class', 'match2max', 'none']:
     print('\nWeight type', args.weight_type, 'not recognized --> setting it to none')
     args.weight_type = 'none'
+if args.host_dtype not in ['float16', 'float32']:
+    print('\nHost dtype', args.host_dtype, 'not recognized --> setting it to float32')
+    args.host_dtype = 'float32'
+host_dtype  = np.float16 if args.host_dtype == 'float16' else None
+batch_dtype = np.float32 if args.host_dtype == 'float16' else None
+if args.cache == 'ON': init_block_cache(max_size=args.cache_size*1e9)
+h5_pool.max_cache = args.h5_cache*1e9
 if '.h5' not in args.model_in and args.n_epochs < 1 and args.n_folds==1:
     print('\nERROR: no valid model file\n'); sys.exit()
 
@@ -129,7 +151,8 @@ if args.results_in != '': sys.exit()
 
 # TRAINING DATA
 data_files = get_dataset(args.input_path, args.input_dir, args.host_name)
-keys    = set().union(*[h5py.File(data_file,'r').keys() for data_file in data_files])
+manifest   = get_manifest(data_files, verbose='OFF')
+keys    = set().union(*[manifest[data_file]['keys'] for data_file in data_files])
 images  = [key for key in images  if key in keys or key=='tracks']
 scalars = [key for key in scalars if key in keys or key=='tracks']
 others  = [key for key in others  if key in keys]
@@ -150,8 +173,9 @@ input_data = {**train_data, 'others':others}
 if   args.images == 'ON': n_limit =   20e6
 elif args.tracks == 'ON': n_limit =   50e6
 else                    : n_limit = 1000e6
+if host_dtype is not None: n_limit *= 2
 if max(args.n_train, args.n_valid) > n_limit: args.generator = 'ON'
-sample_size  = sum([len(h5py.File(data_file,'r')['eventNumber']) for data_file in data_files])
+sample_size  = sum([manifest[data_file]['n_e'] for data_file in data_files])
 args.n_train = [0, min(sample_size, args.n_train)]
 args.n_valid = [args.n_train[1], min(args.n_train[1]+args.n_valid, sample_size)]
 if args.n_valid[0] == args.n_valid[1]: args.n_valid = args.n_train
@@ -161,17 +185,18 @@ if args.n_eval[0] == args.n_eval[1]: args.n_eval = args.n_valid
 
 
 # MODEL CREATION / MULTI-GPU DISTRIBUTION
-sample = make_sample(data_files[0], [0,1], input_data, args.n_tracks, args.n_etypes)[0]
+args.scaling   = args.scaling   == 'ON' and list(set(scalars)-{'tracks'}) != []
+args.t_scaling = args.t_scaling == 'ON' and 'tracks' in scalars+images
+host_scaling   = args.generator != 'ON' and args.in_graph != 'ON'
+sample = manifest_sample(data_files[0], input_data, args.n_tracks)
 n_gpus = min(args.n_gpus, len(tf.config.experimental.list_physical_devices('GPU')))
-model  = create_model(args.n_etypes, sample, args.NN_type, args.FCN_neurons, CNN,
-                      args.l2, args.dropout, train_data, n_gpus)
+model  = create_model(args.n_etypes, sample, args.NN_type, args.FCN_neurons, CNN, args.l2, args.dropout, train_data,
+                      n_gpus, args.scaling and args.in_graph=='ON', args.t_scaling and args.in_graph=='ON')
 train_batch_size = args.batch_size                 #* max(1,n_gpus)
 valid_batch_size = max(args.batch_size, int(20e3)) #* max(1,n_gpus)
 
 
 # ARGUMENTS AND VARIABLES SUMMARY
-args.scaling   = args.scaling   == 'ON' and list(set(scalars)-{'tracks'}) != []
-args.t_scaling = args.t_scaling == 'ON' and 'tracks' in scalars+images
 if args.NN_type == 'CNN':
     print('\nCNN ARCHITECTURE:')
     for shape in [shape for shape in CNN if shape in [sample[key].shape[1:] for key in sample]]:
@@ -194,6 +219,7 @@ print(tabulate(table, headers=headers, tablefmt='psql')); print()
 args.model_in    = args.output_dir+'/'+args.model_in   ; args.model_out    = args.output_dir+'/'+args.model_out
 args.scaler_in   = args.output_dir+'/'+args.scaler_in  ; args.scaler_out   = args.output_dir+'/'+args.scaler_out
 args.t_scaler_in = args.output_dir+'/'+args.t_scaler_in; args.t_scaler_out = args.output_dir+'/'+args.t_scaler_out
+args.weights_in  = args.output_dir+'/'+args.weights_in ; args.weights_out  = args.output_dir+'/'+args.weights_out
 #plot_inputs(args.input_path, args.host_name, input_data, args.n_valid,
 #            args.n_tracks, args.n_etypes, args.valid_cuts, args.output_dir)
 
@@ -205,7 +231,7 @@ if os.path.isfile(args.model_in):
         model.load_weights(args.model_in)
     except ValueError:
         print('PRE-TRAINED NETWORK ARCHITECTURE')
-        model = tf.keras.models.load_model(args.model_in)
+        model = tf.keras.models.load_model(args.model_in, custom_objects=custom_layers)
         model.summary(); print() #print(model.output_shape)
 
 
@@ -213,16 +239,21 @@ if os.path.isfile(args.model_in):
 scaler, t_scaler = None, None
 if args.scaling and os.path.isfile(args.scaler_in):
     print('Loading quantile transform from', args.scaler_in  , '\n')
-    scaler = pickle.load(open(args.scaler_in, 'rb'))
+    scaler = load_scaler(args.scaler_in)
 if args.t_scaling and os.path.isfile(args.t_scaler_in):
     print('Loading quantile transform from', args.t_scaler_in, '\n')
-    t_scaler = pickle.load(open(args.t_scaler_in, 'rb'))
+    t_scaler = load_scaler(args.t_scaler_in)
+if args.in_graph == 'ON':
+    #scalers copied to the model layers, none applied on host
+    set_scalers(model, scaler_engine(scaler), scaler_engine(t_scaler), scalars); scaler, t_scaler = None, None
 inputs = {'scalars':scalars, 'images':[], 'others':others} if args.generator == 'ON' else input_data
-valid_scaler   = None if args.generator=='ON' else scaler
-valid_t_scaler = None if args.generator=='ON' else t_scaler
+valid_scaler   = scaler   if host_scaling else None
+valid_t_scaler = t_scaler if host_scaling else None
 print('VALIDATION SAMPLE: loading', np.diff(args.n_valid)[0], 'electron-candidates')
-valid_sample, valid_labels, _ = merge_samples(data_files, args.n_valid, inputs, args.n_tracks,
-                                              args.n_etypes, args.valid_cuts, valid_scaler, valid_t_scaler)
+valid_sample, valid_labels, _ = merge_samples(data_files, args.n_valid, inputs, args.n_tracks, args.n_etypes,
+                                              args.valid_cuts, valid_scaler, valid_t_scaler, args.n_tasks,
+                                              lazy=args.generator=='ON', host_dtype=host_dtype,
+                                              shared=args.shared=='ON')
 #sample_composition(valid_sample); compo_matrix(valid_labels, n_etypes=args.n_etypes)         ; sys.exit()
 #sample_analysis(valid_sample, valid_labels, scalars, scaler, args.generator, args.output_dir); sys.exit()
 
@@ -243,60 +274,113 @@ if args.n_epochs > 0:
     print('Using'           , args.NN_type, 'architecture with', end=' ')
     print([key for key in train_data if train_data[key] != []], '\n'    )
     print('TRAINING SAMPLE: loading', np.diff(args.n_train)[0], 'electron-candidates')
-    if args.t_scaling and not os.path.isfile(args.t_scaler_in) and 'tracks' in images and args.generator == 'ON':
-        inputs['images'] = ['tracks']
-    train_sample, train_labels, weight_idx = merge_samples(data_files, args.n_train, inputs, args.n_tracks,
-                                                           args.n_etypes, args.train_cuts)
-    sample_composition(train_sample, 'train'); compo_matrix(valid_labels, train_labels); print() #; sys.exit()
-    train_weights, bins = get_sample_weights(train_sample, train_labels, args.weight_type, args.bkg_ratio, hist='pt')
-    sample_histograms(valid_sample, valid_labels, train_sample, train_labels, args.n_etypes,
+    if args.generator == 'ON':
+        #composition and (pt, eta) histograms accumulated over the generator batches, the training sample is
+        #only loaded (tracks) to fit the tracks scaler
+        train_counts, hist_bins, compo = stream_hists(data_files, args.n_train, args.train_cuts, args.n_etypes,
+                                                      hist_file=args.output_dir+'/weight_hists.npz',
+                                                      n_tasks=args.n_tasks)
+        sample_composition(None, 'train', compo)
+        compo_matrix(valid_labels, n_etypes=args.n_etypes, train_counts=np.sum(train_counts, axis=(1,2))); print()
+        train_sample, train_labels = None, None
+        if args.t_scaling and not os.path.isfile(args.t_scaler_in):
+            if 'tracks' in images: inputs['images'] = ['tracks']
+            train_sample = merge_samples(data_files, args.n_train, inputs, args.n_tracks, args.n_etypes,
+                                         args.train_cuts, n_tasks=args.n_tasks, lazy=True, host_dtype=host_dtype,
+                                         shared=args.shared=='ON')[0]
+    else:
+        train_sample, train_labels, _      = merge_samples(data_files, args.n_train, inputs, args.n_tracks,
+                                                           args.n_etypes, args.train_cuts, n_tasks=args.n_tasks,
+                                                           host_dtype=host_dtype, shared=args.shared=='ON')
+        train_counts = None
+        sample_composition(train_sample, 'train'); compo_matrix(valid_labels, train_labels); print() #; sys.exit()
+    #sample weights as a (class, pt, eta) lookup table, evaluated batch by batch in generator mode
+    if os.path.isfile(args.weights_in):
+        print('Loading sample weights table from', args.weights_in, '\n')
+        weight_table, bins = load_weight_table(args.weights_in)
+    else:
+        if args.generator == 'ON':
+            weight_table, bins = hist_weights(train_counts, hist_bins, args.weight_type, args.bkg_ratio, hist='pt')
+        else: weight_table, bins = get_sample_weights(train_sample, train_labels, args.weight_type, args.bkg_ratio,
+                                                      hist='pt')
+        if weight_table is not None: save_weight_table(weight_table, bins, args.weights_out)
+    if args.generator == 'ON':
+        #training histograms plotted from the counts, on their bins
+        bins = hist_bins; hist_sample, hist_labels, train_weights = count_sample(train_counts, bins, weight_table)
+    else:
+        hist_sample, hist_labels = train_sample, train_labels
+        train_weights = None if weight_table is None else weight_table(train_sample, train_labels)
+    sample_histograms(valid_sample, valid_labels, hist_sample, hist_labels, args.n_etypes,
                       train_weights, bins, args.output_dir) ; print() #; sys.exit()
     if args.scaling:
         if not os.path.isfile(args.scaler_in):
-            scaler = fit_scaler(train_sample, scalars, args.scaler_out)
-            if args.generator != 'ON': valid_sample = apply_scaler(valid_sample, scalars, scaler, verbose='OFF')
-        if args.generator != 'ON': train_sample = apply_scaler(train_sample, scalars, scaler, verbose='ON')
+            if args.generator == 'ON': scaler = sketch_scaler(data_files, args.n_train, scalars, args.train_cuts,
+                                                              args.n_etypes, args.scaler_out, args.n_tasks)
+            else                     : scaler = fit_scaler(train_sample, scalars, args.scaler_out)
+            if host_scaling: valid_sample = apply_scaler(valid_sample, scalars, scaler, verbose='OFF',
+                                                         dtype=host_dtype or np.float32)
+        if host_scaling: train_sample = apply_scaler(train_sample, scalars, scaler, verbose='ON',
+                                                     dtype=host_dtype or np.float32)
     if args.t_scaling:
         if not os.path.isfile(args.t_scaler_in):
             t_scaler = fit_t_scaler(train_sample, args.t_scaler_out)
-            if args.generator != 'ON': valid_sample = apply_t_scaler(valid_sample, t_scaler, verbose='OFF')
-        if args.generator != 'ON': train_sample = apply_t_scaler(train_sample, t_scaler, verbose='ON')
+            if host_scaling: valid_sample = apply_t_scaler(valid_sample, t_scaler, verbose='OFF',
+                                                           dtype=host_dtype)
+        if host_scaling: train_sample = apply_t_scaler(train_sample, t_scaler, verbose='ON',
+                                                       dtype=host_dtype)
+    if args.in_graph == 'ON':
+        set_scalers(model, scaler_engine(scaler), scaler_engine(t_scaler), scalars); scaler, t_scaler = None, None
     callbacks = callback(args.model_out, args.patience, args.metrics)
     print('TRAINING ON SAMPLE', args.n_train)
     if args.generator == 'ON':
         del(train_sample)
-        if np.all(train_weights) != None: train_weights = gen_weights(args.n_train, weight_idx, train_weights)
-        train_gen = Batch_Generator(data_files, args.n_train, input_data, args.n_tracks, args.n_etypes,
-                                    train_batch_size, args.train_cuts, scaler, t_scaler, train_weights, shuffle='ON')
+        train_gen = Batch_Generator(data_files, args.n_train, input_data, args.n_tracks, args.n_etypes, train_batch_size,
+                                    args.train_cuts, scaler, t_scaler, weight_table, shuffle=args.gen_shuffle,
+                                    dtype=batch_dtype, pack=args.pack)
         eval_gen  = Batch_Generator(data_files, args.n_eval , input_data, args.n_tracks, args.n_etypes,
-                                    valid_batch_size, args.valid_cuts, scaler, t_scaler, shuffle='OFF')
+                                    valid_batch_size, args.valid_cuts, scaler, t_scaler, shuffle='OFF',
+                                    dtype=batch_dtype, pack=args.pack)
+        if args.tf_data == 'ON': train_gen, eval_gen = batch_dataset(train_gen), batch_dataset(eval_gen)
         training  = model.fit( train_gen, validation_data=eval_gen, max_queue_size=100*max(1,n_gpus),
-                               callbacks=callbacks, workers=1, epochs=args.n_epochs, verbose=args.verbose )
+                               callbacks=callbacks, workers=1, epochs=args.n_epochs, verbose=args.verbose,
+                               shuffle=args.gen_shuffle!='stream' and args.pack!='ON' )
     else:
         eval_sample = {key:valid_sample[key][:args.n_eval[1]-args.n_valid[0]] for key in valid_sample}
         eval_labels =      valid_labels     [:args.n_eval[1]-args.n_valid[0]]
-        training = model.fit( train_sample, train_labels, validation_data=(eval_sample,eval_labels),
-                              callbacks=callbacks, sample_weight=train_weights, batch_size=train_batch_size,
-                              epochs=args.n_epochs, verbose=args.verbose )
+        if host_dtype is not None:
+            #float16 host arrays are widened batch by batch
+            train_seq = Sample_Sequence(train_sample, train_labels, train_batch_size, train_weights, shuffle='ON')
+            eval_seq  = Sample_Sequence(eval_sample , eval_labels , valid_batch_size)
+            training  = model.fit( train_seq, validation_data=eval_seq, callbacks=callbacks, workers=1,
+                                   epochs=args.n_epochs, verbose=args.verbose )
+        else:
+            training = model.fit( train_sample, train_labels, validation_data=(eval_sample,eval_labels),
+                                  callbacks=callbacks, sample_weight=train_weights, batch_size=train_batch_size,
+                                  epochs=args.n_epochs, verbose=args.verbose )
+    if args.generator == 'ON': print('HDF5 pool:', h5_pool.stats())
     model.load_weights(args.model_out); print()
 else:
-    train_labels = None ; training = None
+    train_labels = None ; train_counts = None ; training = None
 
 
 # PLOTTING PERFORMANCE RESULTS
 if args.n_folds > 1:
-    valid_probs = cross_valid(valid_sample, valid_labels, scalars, args.output_dir, args.n_folds, data_files,
-                              args.n_valid, input_data, args.n_tracks, args.valid_cuts, model, args.generator)
+    valid_probs = cross_valid(valid_sample, valid_labels, [] if args.in_graph=='ON' else scalars, args.output_dir,
+                              args.n_folds, data_files, args.n_valid, input_data, args.n_tracks, args.valid_cuts,
+                              model, args.generator)
 else:
     print('VALIDATING ON SAMPLE', args.n_valid)
     if args.generator == 'ON':
         valid_gen   = Batch_Generator(data_files, args.n_valid, input_data, args.n_tracks, args.n_etypes,
-                                      valid_batch_size, args.valid_cuts, scaler, t_scaler, shuffle='OFF')
+                                      valid_batch_size, args.valid_cuts, scaler, t_scaler, shuffle='OFF',
+                                      dtype=batch_dtype)
         valid_probs = model.predict(valid_gen, verbose=args.verbose)
+    elif host_dtype is not None:
+        valid_probs = model.predict(Sample_Sequence(valid_sample, None, valid_batch_size), verbose=args.verbose)
     else:
         valid_probs = model.predict(valid_sample, batch_size=valid_batch_size, verbose=args.verbose)
 bkg_rej = valid_results(valid_sample, valid_labels, valid_probs, train_labels,
-                        args.n_etypes, args.output_dir, args.plotting)
+                        args.n_etypes, args.output_dir, args.plotting, train_counts=train_counts)
 if '.pkl' in args.results_out:
     args.results_out = args.output_dir+'/'+args.results_out
     if args.feature_removal == 'ON':
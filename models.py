@@ -1,14 +1,112 @@
 import numpy      as np
 import tensorflow as tf
 from tensorflow.keras.layers import Conv2D, Conv3D, MaxPooling2D, MaxPooling3D, LeakyReLU
-from tensorflow.keras.layers import Flatten, Dense, concatenate, Reshape, Dropout, BatchNormalization
+from tensorflow.keras.layers import Flatten, Dense, concatenate, Reshape, Dropout, BatchNormalization, Layer
 from tensorflow.keras        import Input, regularizers, models, callbacks, mixed_precision, optimizers
 import sys
 
 
-def multi_CNN(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, scalars, images, batchNorm=False):
+def normal_quantile(p):
+    #ndtri from the rational approximations of P. J. Acklam (relative error 1.2e-9), with ops the ONNX
+    #converters support (tf.math.ndtri has no ONNX equivalent), evaluated in float64 against float32 cancellations
+    a = [-3.969683028665376e+01,  2.209460984245205e+02, -2.759285104469687e+02,  1.383577518672690e+02,
+         -3.066479806614716e+01,  2.506628277459239e+00]
+    b = [-5.447609879822406e+01,  1.615858368580409e+02, -1.556989798598866e+02,  6.680131188771972e+01,
+         -1.328068155288572e+01,  1.]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00,
+          4.374664141464968e+00,  2.938163982698783e+00]
+    d = [ 7.784695709041462e-03,  3.224671290700398e-01,  2.445134137142996e+00,  3.754408661907416e+00, 1.]
+    def poly(coefs, x): return tf.math.polyval([tf.constant(coef, x.dtype) for coef in coefs], x)
+    x = tf.cast(p, tf.float64); q = x - 0.5; r = q*q; tail = tf.minimum(x, 1-x)
+    central = q*poly(a, r)/poly(b, r)
+    t       = tf.sqrt(-2*tf.math.log(tf.maximum(tail, 1e-30)))
+    tail    = tf.sign(q)*-poly(c, t)/poly(d, t)
+    return tf.cast(tf.where(tf.abs(q) <= 0.5-0.02425, central, tail), p.dtype)
+def upper_bound(table, x):
+    #searchsorted(table, x, side='right') of a sorted table as a binary search of fixed depth (the UpperBound op
+    #of tf.searchsorted has no ONNX equivalent)
+    count = tf.zeros_like(x, dtype=tf.int32); size = table.shape[0]
+    for step in [2**n for n in reversed(range(int(np.log2(size))+1))]:
+        below = tf.gather(table, tf.minimum(count+step, size)-1) <= x
+        count = tf.where(below & (count+step <= size), count+step, count)
+    return count
+class Quantile_Scaling(Layer):
+    #QuantileTransformer of one scalar in the graph, with the knot tables of utils.Quantile_Engine padded to
+    #n_knots by +inf; the tables are non-trainable weights set by set_scalers and saved with the model; as in the
+    #engine, quantiles are interpolated in float64 and rounded to float32 before the normal quantile, since float32
+    #interpolation is off by a few float32 steps near 0 and 1 and the normal tails amplify these (3.5e-4 at 4 sigma)
+    def __init__(self, n_knots=10000, normal=True, **kwargs):
+        super().__init__(dtype='float32', **{key:kwargs[key] for key in kwargs if key != 'dtype'})
+        self.n_knots, self.normal = n_knots, normal
+    def build(self, input_shape):
+        self.tables = self.add_weight(name='tables', shape=(4,self.n_knots), initializer='zeros', trainable=False,
+                                      dtype='float64')
+        self.bounds = self.add_weight(name='bounds', shape=(2,)            , initializer='zeros', trainable=False,
+                                      dtype='float64')
+    def set_tables(self, knots, middle, upper, slope):
+        #knots equal in float32 (e.g. 1 and 1+eps of integer-valued scalars) are merged into one knot mapped as in
+        #float64 at its float32 value, the next segment starting from the last knot merged
+        slope  = np.append(slope, 0)
+        first  = np.flatnonzero(np.append(True, np.diff(np.float32(knots)) != 0))
+        last   = np.append(first[1:], len(knots)) - 1
+        merged = np.float64(np.float32(knots[first]))
+        index  = np.clip(np.searchsorted(knots, merged, side='right') - 1, 0, len(knots)-1)
+        middle = np.where(knots[index] == merged, middle[index], upper[index] + (merged-knots[index])*slope[index])
+        middle = np.clip(middle, 0, 1)
+        upper, slope = upper[last] + (merged-knots[last])*slope[last], slope[last]
+        if len(merged) > self.n_knots: raise ValueError('scaler has more than '+str(self.n_knots)+' knots')
+        tables = np.zeros((4,self.n_knots)); tables[0,:] = np.inf
+        for n, table in enumerate([merged, middle, upper, slope]): tables[n,:len(table)] = table
+        self.set_weights([tables, np.array([knots[0], knots[-1]])])
+    def call(self, inputs):
+        raw   = tf.reshape(tf.cast(inputs, tf.float32), [-1]); x = tf.cast(raw, tf.float64)
+        index = tf.clip_by_value(upper_bound(self.tables[0], x) - 1, 0, self.n_knots-1)
+        knots, middle, upper, slope = [tf.gather(table, index) for table in tf.unstack(self.tables)]
+        values = tf.where(x == knots, middle, upper + (x - knots)*slope)
+        zeros, ones = tf.zeros_like(values), tf.ones_like(values)
+        if self.normal:
+            below, above = tf.cast(raw - 1e-7, tf.float64), tf.cast(raw + 1e-7, tf.float64)
+            values = tf.where(below < self.bounds[0], zeros, tf.where(above > self.bounds[1], ones, values))
+            #the [0,1] clip keeps the float32 rounding in ONNX graphs, where tf2onnx merges back-to-back casts
+            values = tf.clip_by_value(tf.cast(values, tf.float32), 0., 1.)
+            values = tf.clip_by_value(tf.cast(normal_quantile(values), tf.float64), -5.19933758, 5.19933758)
+        else: values = tf.where(x <= self.bounds[0], zeros, tf.where(x >= self.bounds[1], ones, values))
+        return tf.reshape(tf.cast(tf.where(tf.math.is_nan(x), x, values), tf.float32), tf.shape(inputs))
+    def get_config(self):
+        return dict(super().get_config(), n_knots=self.n_knots, normal=self.normal)
+class Robust_Scaling(Layer):
+    #RobustScaler of the tracks features in the graph, set by set_scalers from utils.Robust_Engine
+    def __init__(self, **kwargs):
+        super().__init__(dtype='float32', **{key:kwargs[key] for key in kwargs if key != 'dtype'})
+    def build(self, input_shape):
+        self.center = self.add_weight(name='center', shape=input_shape[-1:], initializer='zeros', trainable=False)
+        self.scale  = self.add_weight(name='scale' , shape=input_shape[-1:], initializer='ones' , trainable=False)
+    def call(self, inputs):
+        return (tf.cast(inputs, tf.float32) - self.center) / self.scale
+custom_layers = {'Quantile_Scaling':Quantile_Scaling, 'Robust_Scaling':Robust_Scaling}
+
+
+def set_scalers(model, scaler=None, t_scaler=None, scalars=[]):
+    #scaler and t_scaler: Quantile_Engine and Robust_Engine (utils.scaler_engine) copied to the scaling layers
+    layers = {layer.name:layer for layer in model.layers}
+    if scaler is not None:
+        for n, key in enumerate([key for key in scalars if key != 'tracks']):
+            if 'scaling_'+key in layers: layers['scaling_'+key].set_tables(*scaler.tables[n])
+    if t_scaler is not None and 'scaling_tracks' in layers:
+        layers['scaling_tracks'].set_weights([t_scaler.center, t_scaler.scale])
+
+
+def multi_CNN(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, scalars, images, batchNorm=False,
+              scaling=False, t_scaling=False):
+    #scaling, t_scaling: quantile transform of the scalars and robust scaling of the tracks inside the model
     regularizer = regularizers.l2(l2)
     input_dict  = {key:Input(shape=sample[key].shape[1:], name=key) for key in scalars+images}
+    inputs      = list(input_dict.values())
+    for key in input_dict:
+        if key == 'tracks' and t_scaling:
+            input_dict[key] = Robust_Scaling  (name='scaling_'+key)                                (input_dict[key])
+        if key != 'tracks' and scaling and key in scalars:
+            input_dict[key] = Quantile_Scaling(name='scaling_'+key)                                (input_dict[key])
     shape_set   = set([sample[key].shape[1:] for key in images])
     output_list = []
     #IMAGES CNN
@@ -66,17 +164,19 @@ def multi_CNN(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, scalars
         outputs = LeakyReLU(alpha=0)                                                               (outputs)
         outputs = Dropout(dropout)                                                                 (outputs)
     outputs = Dense(n_classes, activation='softmax', dtype='float32')                              (outputs)
-    return models.Model(inputs = list(input_dict.values()), outputs = outputs)
+    return models.Model(inputs = inputs, outputs = outputs)
 
 
-def create_model(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, train_var, n_gpus):
+def create_model(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, train_var, n_gpus,
+                 scaling=False, t_scaling=False):
     tf.debugging.set_log_device_placement(False)
     strategy = tf.distribute.MirroredStrategy(devices=['/gpu:'+str(n) for n in range(n_gpus)])
     with strategy.scope():
         if tf.__version__ >= '2.1.0':
             mixed_precision.experimental.set_policy('mixed_float16')
         if 'tracks' in train_var['images']: CNN[sample['tracks'].shape[1:]] = CNN.pop('tracks')
-        model = multi_CNN(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, **train_var)
+        model = multi_CNN(n_classes, sample, NN_type, FCN_neurons, CNN, l2, dropout, **train_var,
+                          scaling=scaling, t_scaling=t_scaling)
         print('\nNEURAL NETWORK ARCHITECTURE'); model.summary()
         optimizer = optimizers.Adam(lr=1e-4, amsgrad=False)
         model.compile(optimizer=optimizer, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
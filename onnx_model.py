@@ -3,11 +3,12 @@
 
 
 # IMPORT PACKAGES AND FUNCTIONS
-import numpy as np, os, pickle
+import numpy as np, os
 import onnx, keras2onnx, onnxruntime as ort
 from   tensorflow.keras import models
 from   argparse         import ArgumentParser
-from   utils            import get_dataset, merge_samples
+from   utils            import get_dataset, merge_samples, Sample_Sequence, load_scaler
+from   models           import custom_layers
 
 
 # PROGRAM ARGUMENTS
@@ -23,7 +24,7 @@ args = parser.parse_args(); args.n_valid = int(args.n_valid)
 
 # H5PY TO ONNX CONVERSION
 if args.h5_to_onnx:
-    h5py_model = models.load_model(args.output_dir+'/'+args.model_file)
+    h5py_model = models.load_model(args.output_dir+'/'+args.model_file, custom_objects=custom_layers)
     onnx_model = keras2onnx.convert_keras(h5py_model, h5py_model.name)
     onnx.save_model(onnx_model, args.output_dir+'/'+h5py_model.name+'.onnx')
     sys.exit()
@@ -61,21 +62,25 @@ input_data = {'scalars':scalars, 'images':images, 'others':others}
 
 # GENERATING VALIDATION SAMPLE
 data_files = get_dataset(eta_region=args.eta_region)
-if os.path.isfile(args.output_dir+'/'+args.scaler_file):
+h5py_model = models.load_model(args.output_dir+'/'+args.model_file, custom_objects=custom_layers)
+#models with scaling layers take the unscaled scalars
+in_graph   = any([layer.name.startswith('scaling_') for layer in h5py_model.layers])
+if os.path.isfile(args.output_dir+'/'+args.scaler_file) and not in_graph:
     print('\nLoading scalars scaler from', args.output_dir+'/'+args.scaler_file)
-    scaler = pickle.load(open(args.output_dir+'/'+args.scaler_file, 'rb'))
+    scaler = load_scaler(args.output_dir+'/'+args.scaler_file)
 else: scaler = None
 sample, labels, _ = merge_samples(data_files, (0,args.n_valid), input_data,
                                   n_tracks, n_classes, cuts='', scaler=scaler)
 
 
 # COMPARING INFERENCE BETWEEN H%PY AND ONNX
-sample     = {key:np.float32(sample[key]) for key in images+scalars}
+sample     = {key:sample[key] for key in images+scalars}
 onnx_model = onnx.load(args.output_dir+'/'+'model.onnx')
 output     = [key.name for key in onnx_model.graph.output]
-onnx_probs = sess_ort.run(output, sample)
-h5py_model = models.load_model(args.output_dir+'/'+args.model_file)
-h5py_probs = h5py_model.predict(sample, batch_size=1000)
+onnx_batch = Sample_Sequence(sample, None, 1000)
+onnx_probs = [sess_ort.run(output, onnx_batch[n]) for n in range(len(onnx_batch))]
+onnx_probs = [np.concatenate(probs) for probs in zip(*onnx_probs)]
+h5py_probs = h5py_model.predict(Sample_Sequence(sample, None, 1000))
 
 
 # PREDICTIONS COMPARISON
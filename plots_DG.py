@@ -1,6 +1,6 @@
 import numpy           as np
 import multiprocessing as mp
-import sys, os, h5py, pickle, time, itertools, warnings
+import sys, os, pickle, time, itertools, warnings
 from   functools         import partial
 from   sklearn           import metrics
 from   scipy.spatial     import distance
@@ -1356,14 +1356,14 @@ def LFmc_downsampling(data_sample, mc_sample, mc_labels, n_bins=101):
 
 def plot_inputs(input_path, host_name, input_data, n_e, n_tracks, n_classes, gen_cuts, output_dir):
     font_manager._get_font.cache_clear()
-    from utils import get_dataset, merge_samples, sample_composition, compo_matrix
+    from utils import get_dataset, get_manifest, merge_samples, sample_composition, compo_matrix
     mc_input   = '0.0-2.5_mc'
     #data_input = 'LFdata/LFdata_17-18'
     data_input = 'Zee+JF17+data'
     mc_files   = get_dataset(input_path,   mc_input, host_name)
     data_files = get_dataset(input_path, data_input, host_name)
-    ne_mc   = [n_e[0], min(n_e[1], sum([len(h5py.File(n,'r')['eventNumber']) for n in   mc_files]))]
-    ne_data = [n_e[0], min(n_e[1], sum([len(h5py.File(n,'r')['eventNumber']) for n in data_files]))]
+    ne_mc   = [n_e[0], min(n_e[1], sum([n['n_e'] for n in get_manifest(  mc_files, verbose='OFF').values()]))]
+    ne_data = [n_e[0], min(n_e[1], sum([n['n_e'] for n in get_manifest(data_files, verbose='OFF').values()]))]
     print('\nLoading sample [', format(str(ne_mc[0])  ,'>8s')+', '+format(str(ne_mc[1])  ,'>8s'), end=']')
     print(' from', mc_files[0].split('/')[-2], flush=True)
     mc_sample  , mc_labels  , _ = merge_samples(  mc_files, ne_mc  , input_data, n_tracks, n_classes  , cuts=gen_cuts)
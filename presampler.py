@@ -1,10 +1,11 @@
 # IMPORT PACKAGES AND FUNCTIONS
 import numpy           as np
 import multiprocessing as mp
-import time, os, sys, h5py
+import time, os, sys
 from   argparse  import ArgumentParser
 from   functools import partial
-from   utils     import presample, merge_presamples, mix_datafiles, mix_presamples
+from   utils     import presample, merge_presamples, mix_datafiles, mix_presamples, get_manifest
+from   utils     import prescale_files, load_scaler
 
 
 # OPTIONS
@@ -18,6 +19,9 @@ parser.add_argument( '--merging'    , default = 'OFF'             )
 parser.add_argument( '--input_dir'  , default = 'inputs'          )
 parser.add_argument( '--output_dir' , default = 'outputs'         )
 parser.add_argument( '--merged_file', default = 'e-ID.h5'         )
+parser.add_argument( '--prescaling' , default = 'OFF'             ) #training-ready files from fitted scalers
+parser.add_argument( '--scaler_in'  , default = 'scaler.pkl'      )
+parser.add_argument( '--t_scaler_in', default = ''                )
 args = parser.parse_args()
 
 
@@ -29,6 +33,14 @@ if args.mixing == 'ON':
     sys.exit()
 
 
+# PRESAMPLES SCALING
+if args.prescaling == 'ON':
+    data_files = sorted([args.input_dir+'/'+h5_file for h5_file in os.listdir(args.input_dir) if '.h5' in h5_file])
+    t_scaler   = load_scaler(args.t_scaler_in) if os.path.isfile(args.t_scaler_in) else None
+    prescale_files(data_files, args.output_dir, load_scaler(args.scaler_in), t_scaler, n_tasks=args.n_tasks)
+    sys.exit()
+
+
 # DATASET
 input_path  = '/opt/tmp/godin/e-ID_data/2020-10-30'
 #input_path  = '/nvme1/atlas/godin/e-ID_data/data_15-18'
@@ -94,16 +106,16 @@ for h5_file in h5_files: os.remove(output_dir+'/'+h5_file)
 
 
 # STARTING SAMPLING AND COLLECTING DATA
-n_tasks = min(mp.cpu_count(), args.n_tasks)
-max_e   = [len(h5py.File(h5_file,'r')[key]['eventNumber'])
-           for h5_file in data_files for key in h5py.File(h5_file,'r')]
+n_tasks  = min(mp.cpu_count(), args.n_tasks)
+manifest = get_manifest(data_files)
+max_e    = [manifest[h5_file]['groups'][key] for h5_file in data_files for key in manifest[h5_file]['groups']]
 n_e = min(int(args.n_e), sum(max_e)) if args.n_e is not None else sum(max_e)
 n_e = np.int_(np.round(np.array(max_e)*min(1,n_e/sum(max_e)))) // n_tasks * n_tasks
 print('\nSTARTING ELECTRONS COLLECTION (', '\b'+str(sum(n_e)), end=' ', flush=True)
 print('electrons from', len(data_files),'files, using', n_tasks,'threads):')
 pool = mp.Pool(n_tasks); sum_e = 0; index = 0
 for h5_file in data_files:
-    for file_key in h5py.File(h5_file,'r'):
+    for file_key in manifest[h5_file]['groups']:
         print('Collecting', format(str(n_e[index]),'>7s'), 'e from:', h5_file.split('/')[-1], end=' ')
         print(format('['+file_key+']','7s'), end=' ... ', flush=True); start_time = time.time()
         n_passes = int(np.ceil(n_e[index]/1e6)) # 1e6 electrons per pass
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+#resampling on index arrays: the rows selected or drawn are returned as indices into the sample, to be taken by
+#the caller, without sets over the rows or full-array scans per bin
+pt_bins = [0, 10, 20, 30, 40, 60, 80, 100, 130, 180, 250, 500]
+
+
+def complement(rows, n_e):
+    #rows of range(n_e) not in rows, in increasing order
+    mask = np.ones(n_e, dtype=bool); mask[rows] = False
+    return np.flatnonzero(mask)
+def bin_groups(bin_idx, labels, n_bins):
+    #rows of the signal then background electrons of each bin, in increasing order, from one stable sort;
+    #rows outside the bins are in no group
+    keys   = np.where(labels==0, 0, n_bins) + bin_idx
+    keys   = np.where((bin_idx>=0) & (bin_idx<n_bins), keys, 2*n_bins)
+    counts = np.bincount(keys, minlength=2*n_bins+1)
+    groups = np.split(np.argsort(keys, kind='stable'), np.cumsum(counts)[:-1])
+    return groups[:n_bins], groups[n_bins:2*n_bins]
+def bootstrap(rows, n_draws, random=np.random):
+    #draws among rows, with replacement only when there are more draws than rows
+    return random.choice(rows, n_draws, replace=len(rows)<n_draws)
+
+
+def downsampling_indices(pt, labels, bkg_ratio=None, bins=pt_bins):
+    #rows of the validation electrons matching the signal and background pt distributions (to bkg_ratio), in
+    #bin order, and the remaining rows in increasing order
+    bin_idx  = np.digitize(pt, bins, right=True) -1
+    hist_sig = np.histogram(pt[labels==0], bins)[0]
+    hist_bkg = np.histogram(pt[labels!=0], bins)[0]
+    if bkg_ratio == None: bkg_ratio = np.sum(hist_bkg)/np.sum(hist_sig)
+    total_sig = np.int_(np.around(np.minimum(hist_sig, hist_bkg/bkg_ratio)))
+    total_bkg = np.int_(np.around(np.minimum(hist_bkg, hist_sig*bkg_ratio)))
+    ind_sig, ind_bkg = bin_groups(bin_idx, labels, len(bins)-1)
+    valid_ind = np.concatenate([ind_sig[n][:total_sig[n]] for n in np.arange(len(bins)-1)] +
+                               [ind_bkg[n][:total_bkg[n]] for n in np.arange(len(bins)-1)])
+    return valid_ind, complement(valid_ind, len(pt))
+def upsampling_indices(labels, bin_idx, new_sig, new_bkg):
+    #rows of each bin completed by new_sig signal and new_bkg background draws among the rows of the bin
+    ind_sig, ind_bkg = bin_groups(bin_idx, labels, len(new_sig))
+    np.random.seed(0)
+    ind_sig = [np.append(ind_sig[n], bootstrap(ind_sig[n], new_sig[n])) for n in np.arange(len(new_sig))]
+    ind_bkg = [np.append(ind_bkg[n], bootstrap(ind_bkg[n], new_bkg[n])) for n in np.arange(len(new_bkg))]
+    return np.concatenate(ind_sig + ind_bkg)
@@ -0,0 +1,39 @@
+# Input pipelines throughput: Batch_Generator (keras Sequence) vs tf.data (batch_dataset)
+import time, os
+from   argparse import ArgumentParser
+from   tabulate import tabulate
+from   utils    import get_dataset, get_manifest, label_keys, Batch_Generator, batch_dataset, load_scaler
+
+parser = ArgumentParser()
+parser.add_argument( '--host_name'  , default = 'lps'                )
+parser.add_argument( '--input_path' , default = ''                   )
+parser.add_argument( '--input_dir'  , default = '0.0-2.5_mc'         )
+parser.add_argument( '--n_e'        , default = 1e6  , type = float  )
+parser.add_argument( '--batch_size' , default = 5e3  , type = float  )
+parser.add_argument( '--n_tracks'   , default = 5    , type = int    )
+parser.add_argument( '--n_classes'  , default = 2    , type = int    )
+parser.add_argument( '--n_epochs'   , default = 2    , type = int    )
+parser.add_argument( '--scaler_in'  , default = ''                   )
+args = parser.parse_args()
+
+data_files = get_dataset(args.input_path, args.input_dir, args.host_name)
+datasets   = get_manifest(data_files)[data_files[0]]['datasets']
+images     = [key for key in datasets if len(datasets[key]['shape']) == 3 and key != 'p_tracks'] + ['tracks']
+scalars    = [key for key in datasets if len(datasets[key]['shape']) == 1 and datasets[key]['dtype'] in ['<f2','<f4']
+              and key not in label_keys]
+input_data = {'scalars':scalars, 'images':images, 'others':label_keys}
+scaler     = load_scaler(args.scaler_in) if os.path.isfile(args.scaler_in) else None
+sample_size = sum([manifest['n_e'] for manifest in get_manifest(data_files, verbose='OFF').values()])
+generator  = Batch_Generator(data_files, [0, int(min(args.n_e, sample_size))], input_data, args.n_tracks,
+                             args.n_classes, int(args.batch_size), '', scaler, None, shuffle='OFF')
+
+def throughput(batches, n_epochs):
+    n_e, start_time = 0, time.time()
+    for epoch in range(n_epochs):
+        for batch in batches(): n_e += len(batch[1])
+    return n_e/(time.time() - start_time)
+sequence = lambda: (generator[n] for n in range(len(generator)))
+dataset  = batch_dataset(generator)
+results  = [['Batch_Generator', format(throughput(sequence         , args.n_epochs), '.0f')],
+            ['tf.data'        , format(throughput(dataset.__iter__ , args.n_epochs), '.0f')]]
+print(tabulate(results, headers=['pipeline', 'samples/s'], tablefmt='psql'))
@@ -0,0 +1,49 @@
+# Scalars quantile transform throughput: sklearn QuantileTransformer.transform vs Quantile_Engine
+import numpy as np, time, os
+from   argparse import ArgumentParser
+from   tabulate import tabulate
+from   sklearn  import preprocessing
+from   utils    import get_dataset, get_manifest, label_keys, merge_samples, get_n_tasks, scaler_engine, load_scaler
+
+parser = ArgumentParser()
+parser.add_argument( '--host_name'  , default = 'lps'                )
+parser.add_argument( '--input_path' , default = ''                   )
+parser.add_argument( '--input_dir'  , default = '0.0-2.5_mc'         )
+parser.add_argument( '--n_e'        , default = 1e6  , type = float  )
+parser.add_argument( '--n_repeats'  , default = 3    , type = int    )
+parser.add_argument( '--scaler_in'  , default = ''                   )
+args = parser.parse_args()
+
+data_files = get_dataset(args.input_path, args.input_dir, args.host_name)
+datasets   = get_manifest(data_files)[data_files[0]]['datasets']
+scalars    = [key for key in datasets if len(datasets[key]['shape']) == 1 and datasets[key]['dtype'] in ['<f2','<f4']
+              and key not in label_keys]
+input_data = {'scalars':scalars, 'images':[], 'others':label_keys}
+sample_size = sum([manifest['n_e'] for manifest in get_manifest(data_files, verbose='OFF').values()])
+sample, _, _ = merge_samples(data_files, [0, int(min(args.n_e, sample_size))], input_data, 0, 2, cuts='')
+columns    = [np.float32(sample[key]) for key in scalars]
+if os.path.isfile(args.scaler_in): scaler = load_scaler(args.scaler_in)
+else: scaler = preprocessing.QuantileTransformer(output_distribution='normal', n_quantiles=10000,
+                                                 random_state=0).fit(np.stack(columns, axis=1))
+
+def throughput(transform):
+    start_time = time.time()
+    for n in range(args.n_repeats): result = transform()
+    return len(columns[0])*args.n_repeats/(time.time() - start_time), result
+def engine(n_threads):
+    outs = [np.empty(len(column), dtype=np.float32) for column in columns]
+    scaler_engine(scaler).transform(columns, outs, n_threads)
+    return np.stack(outs, axis=1)
+rate, reference = throughput(lambda: scaler.transform(np.stack(columns, axis=1)))
+results = [['sklearn', format(rate, '.0f'), '']]
+for n_threads in sorted(set([1, get_n_tasks()])):
+    rate, result = throughput(lambda: engine(n_threads))
+    results += [['Quantile_Engine ('+str(n_threads)+' threads)', format(rate, '.0f'),
+                 format(np.nanmax(np.abs(result - reference)), '.1e')]]
+#float16 columns (as stored in the presampled files) must give the transform of their float32 widening
+columns   = [np.float16(column) for column in columns]
+reference = scaler.transform(np.stack([np.float32(column) for column in columns], axis=1))
+rate, result = throughput(lambda: engine(get_n_tasks()))
+results  += [['Quantile_Engine (float16 inputs)', format(rate, '.0f'),
+               format(np.nanmax(np.abs(result - reference)), '.1e')]]
+print(tabulate(results, headers=['transform', 'samples/s', 'max |diff|'], tablefmt='psql'))
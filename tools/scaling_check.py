@@ -0,0 +1,59 @@
+# Scalars quantile transform of the in-graph Quantile_Scaling layers vs sklearn QuantileTransformer.transform,
+# on float32 inputs; the layers are also run after a tf2onnx conversion with onnxruntime (--onnx OFF to skip)
+import numpy as np, tensorflow as tf, os
+from   argparse import ArgumentParser
+from   tabulate import tabulate
+from   sklearn  import preprocessing
+from   utils    import get_dataset, get_manifest, label_keys, merge_samples, scaler_engine, load_scaler
+from   models   import Quantile_Scaling
+
+parser = ArgumentParser()
+parser.add_argument( '--host_name'  , default = 'lps'                )
+parser.add_argument( '--input_path' , default = ''                   )
+parser.add_argument( '--input_dir'  , default = '0.0-2.5_mc'         )
+parser.add_argument( '--n_e'        , default = 1e6  , type = float  )
+parser.add_argument( '--scaler_in'  , default = ''                   )
+parser.add_argument( '--onnx'       , default = 'ON'                 )
+args = parser.parse_args()
+
+data_files = get_dataset(args.input_path, args.input_dir, args.host_name)
+datasets   = get_manifest(data_files)[data_files[0]]['datasets']
+scalars    = [key for key in datasets if len(datasets[key]['shape']) == 1 and datasets[key]['dtype'] in ['<f2','<f4']
+              and key not in label_keys]
+input_data = {'scalars':scalars, 'images':[], 'others':label_keys}
+sample_size = sum([manifest['n_e'] for manifest in get_manifest(data_files, verbose='OFF').values()])
+sample, _, _ = merge_samples(data_files, [0, int(min(args.n_e, sample_size))], input_data, 0, 2, cuts='')
+columns    = [np.float32(sample[key]) for key in scalars]
+if os.path.isfile(args.scaler_in): scaler = load_scaler(args.scaler_in)
+else: scaler = preprocessing.QuantileTransformer(output_distribution='normal', n_quantiles=10000,
+                                                 random_state=0).fit(np.stack(columns, axis=1))
+#discrete (0.1-rounded) scalars have repeated quantiles and float32 values on the knots
+discrete   = preprocessing.QuantileTransformer(output_distribution='normal', n_quantiles=10000,
+                                               random_state=0).fit(np.round(np.stack(columns, axis=1), 1))
+
+def max_diff(output, reference):
+    #NaN inputs must stay NaN
+    if np.any(np.isnan(output) != np.isnan(reference)): return 'NaN mismatch'
+    return format(np.nanmax(np.abs(output - reference)), '.1e')
+def check(scaler, columns):
+    reference = scaler.transform(np.stack(columns, axis=1)); engine = scaler_engine(scaler); layers = []
+    for n in range(len(columns)):
+        layers += [Quantile_Scaling(normal=scaler.output_distribution=='normal')]
+        layers[-1].build((None,)); layers[-1].set_tables(*engine.tables[n])
+    spec = [tf.TensorSpec((None,), tf.float32, name='input_'+str(n)) for n in range(len(columns))]
+    @tf.function(input_signature=spec)
+    def scaling(*inputs): return [layer(column) for layer, column in zip(layers, inputs)]
+    outputs = [[output.numpy() for output in scaling(*columns)]]
+    if args.onnx == 'ON':
+        import tf2onnx, onnxruntime as ort
+        onnx_model, _ = tf2onnx.convert.from_function(scaling, input_signature=spec)
+        sess_ort = ort.InferenceSession(onnx_model.SerializeToString())
+        outputs += [sess_ort.run(None, {key.name:column for key, column in zip(sess_ort.get_inputs(), columns)})]
+    return [[max_diff(output[n], reference[:,n]) for output in outputs] for n in range(len(columns))]
+results   = check(scaler, columns)
+columns  += [np.round(column, 1) for column in columns]
+results  += check(discrete, columns[len(scalars):])
+results   = [[key, len(np.unique(column[np.isfinite(column)]))] + diffs for key, column, diffs
+             in zip(scalars + [key+' (0.1)' for key in scalars], columns, results)]
+headers   = ['scalar', 'values', 'max |diff| layers'] + (['max |diff| onnx'] if args.onnx == 'ON' else [])
+print(tabulate(results, headers=headers, tablefmt='psql'))
@@ -2,15 +2,18 @@ import tensorflow        as tf
 import numpy             as np
 import multiprocessing   as mp
 import matplotlib.pyplot as plt
-import os, sys, h5py, pickle, time, itertools, warnings
+import os, sys, h5py, pickle, time, itertools, warnings, mmap, ast, hashlib
+import fcntl, atexit, shutil, tempfile
 from   sklearn   import metrics, utils, preprocessing
-from   scipy     import interpolate
+from   scipy     import interpolate, special
 from   functools import partial
+from   collections.abc import MutableMapping
 from   tabulate  import tabulate
 from   skimage   import transform
 from   plots_DG  import plot_history, var_histogram, plot_discriminant, plot_ROC_curves, plot_suppression
 from   plots_DG  import ratio_plots, performance_ratio, performance_plots, plot_classes, plot_heatmaps
 from   plots_KM  import plot_distributions_KM, differential_plots
+from   resampling import downsampling_indices, upsampling_indices
 
 
 #################################################################################
@@ -47,9 +50,7 @@ def get_class_weight(labels, bkg_ratio):
 
 def get_sample_weights(sample, labels, weight_type=None, bkg_ratio=None, hist='2d', ref_class=0, density=False):
     pt = sample['pt']; eta = abs(sample['eta']); n_classes = max(labels)+1
-    pt_bins = get_bins(pt, var_bins=None, max_bins=101, min_bin_count=1, logspace=True, offset=1e-3)
-    for n in np.unique(labels):
-        pt_bins = get_bins(pt[labels==n], var_bins=pt_bins, max_bins=101, min_bin_count=1, logspace=True)
+    pt_bins = get_bins(pt, var_bins=None, max_bins=101, min_bin_count=1, logspace=True, offset=1e-3, labels=labels)
     n_bins   = 50; step = np.max(eta)/n_bins
     eta_bins = np.arange(np.min(eta), np.max(eta)+step, step)
     eta_bins[-1] = max(eta_bins[-1], max(eta)) + 1e-3
@@ -57,21 +58,23 @@ def get_sample_weights(sample, labels, weight_type=None, bkg_ratio=None, hist='2
         return None, {'pt':pt_bins, 'eta':eta_bins}
     if hist == 'pt' : eta_bins = [eta_bins[0], eta_bins[-1]]
     if hist == 'eta':  pt_bins = [ pt_bins[0],  pt_bins[-1]]
-    pt_ind   = np.digitize( pt,  pt_bins, right=False) -1
-    eta_ind  = np.digitize(eta, eta_bins, right=False) -1
-    hist_ref = np.histogram2d(pt[labels==ref_class], eta[labels==ref_class],
-                              bins=[pt_bins,eta_bins], density=density)[0]
-    if density: hist_ref *= np.sum(labels==ref_class)
-    hist_ref = np.maximum(hist_ref, np.min(hist_ref[hist_ref!=0]))
+    hists = np.array([np.histogram2d(pt[labels==n], eta[labels==n], bins=[pt_bins,eta_bins])[0]
+                      for n in np.arange(n_classes)])
+    table = weight_table(hists, pt_bins, eta_bins, weight_type, bkg_ratio, ref_class, density)
+    return table, {'pt':pt_bins, 'eta':eta_bins}
+def weight_table(hists, pt_bins, eta_bins, weight_type, bkg_ratio=None, ref_class=0, density=False):
+    #weights of each class and (pt, eta) bin from the per-class histograms, normalized to a mean weight of 1
+    n_classes = len(hists)
+    counts    = hists
+    if density: hists = hists / np.outer(np.diff(pt_bins), np.diff(eta_bins))
+    hist_ref = np.maximum(hists[ref_class], np.min(hists[ref_class][hists[ref_class]!=0]))
     total_ref_array = []; total_bkg_array = []; hist_bkg_array = []
     if np.isscalar(bkg_ratio):
         bkg_ratio = n_classes*[bkg_ratio]
         #bkg_ratio = [0.25, 1, 1, 1, 1, 1] #; bkg_ratio[-1] = 0.1
         #bkg_ratio = [1, 5, 5, 5, 1, 1]
     for n in [n for n in np.arange(n_classes) if n != ref_class]:
-        hist_bkg = np.histogram2d(pt[labels==n], eta[labels==n], bins=[pt_bins,eta_bins], density=density)[0]
-        if density: hist_bkg *= np.sum(labels==n)
-        hist_bkg = np.maximum(hist_bkg, np.min(hist_bkg[hist_bkg!=0]))
+        hist_bkg = np.maximum(hists[n], np.min(hists[n][hists[n]!=0]))
         ratio    = np.sum(hist_bkg)/np.sum(hist_ref) if bkg_ratio == None else bkg_ratio[n]
         if   weight_type == 'bkg_ratio':
             total_ref = hist_ref * max(1, np.sum(hist_bkg)/np.sum(hist_ref)/ratio)
@@ -96,45 +99,123 @@ def get_sample_weights(sample, labels, weight_type=None, bkg_ratio=None, hist='2
     total_ref_array = np.max(total_ref_array, axis=0)
     total_bkg_array = total_bkg_array / total_ref_ratio
     weights_array = np.concatenate([total_ref_array/hist_ref_array, total_bkg_array/hist_bkg_array])
-    sample_weight = np.zeros(len(labels), dtype=np.float32)
     class_list    = [ref_class] + [n for n in np.arange(n_classes) if n != ref_class]
-    for n in np.arange(n_classes):
-        sample_weight = np.where(labels==class_list[n], weights_array[n,...][pt_ind, eta_ind], sample_weight)
-    return sample_weight*len(labels)/np.sum(sample_weight), {'pt':pt_bins, 'eta':eta_bins}
-
-
-def gen_weights(n_train, weight_idx, sample_weight):
-    weights = np.zeros(np.diff(n_train)[0])
-    np.put(weights, weight_idx, sample_weight)
-    return weights
+    weights_array = weights_array[np.argsort(class_list)]
+    weights_array = weights_array * np.sum(counts)/np.sum(weights_array*counts)
+    return Weight_Table(pt_bins, eta_bins, weights_array)
+class Weight_Table:
+    def __init__(self, pt_bins, eta_bins, values):
+        self.pt_bins  = np.asarray(pt_bins, dtype=np.float64)
+        self.eta_bins = np.asarray(eta_bins, dtype=np.float64)
+        self.values   = np.asarray(values, dtype=np.float64)
+    #weights looked up from the pt and eta columns of a sample or batch
+    def __call__(self, sample, labels):
+        pt_idx  = bin_index(self.pt_bins ,        sample['pt' ] )
+        eta_idx = bin_index(self.eta_bins, np.abs(sample['eta']))
+        return self.values[np.int64(labels), pt_idx, eta_idx]
+def save_weight_table(table, bins, table_out):
+    #framework-free table with the histograms bins of the plots
+    print('Saving sample weights table to', table_out, '\n')
+    np.savez(table_out, pt_bins=table.pt_bins, eta_bins=table.eta_bins, values=table.values,
+             hist_pt=bins['pt'], hist_eta=bins['eta'])
+def load_weight_table(table_in):
+    with np.load(table_in) as data:
+        return (Weight_Table(data['pt_bins'], data['eta_bins'], data['values']),
+                {'pt':data['hist_pt'], 'eta':data['hist_eta']})
+def bin_index(var_bins, var):
+    return np.clip(np.searchsorted(var_bins, var, side='right'), 1, len(var_bins)-1) - 1
+def stream_hists(data_files, idx, cuts, n_classes, hist_file=None, n_tasks=None, batch_size=2**16):
+    #per-class (pt, eta) histograms and (IFF, MC) composition of the training sample accumulated over the generator
+    #batches (a first pass for the bins ranges and the composition, a second one for the counts) or loaded from the
+    #hist_file sidecar when the files (modification times and sizes), the interval and the cuts are unchanged
+    print('Accumulating (pt, eta) histograms', end=' --> ', flush=True); start_time = time.time()
+    manifest = get_manifest(data_files, verbose='OFF')
+    hist_key = str(([(h5_file, manifest[h5_file]['mtime'], manifest[h5_file]['size']) for h5_file in data_files],
+                    [int(n) for n in idx], Cuts(cuts).cuts, n_classes))
+    hist_data = None
+    if hist_file is not None and os.path.isfile(hist_file):
+        with np.load(hist_file) as data:
+            if str(data['key']) == hist_key: hist_data = {key:data[key] for key in data if key != 'key'}
+    if hist_data is not None: print('loaded from', hist_file, end=' ')
+    else:
+        batch_dict = batch_idx(data_files, batch_size, idx, align='ON')
+        n_tasks    = min(get_n_tasks(n_tasks), len(batch_dict))
+        batches    = [[(data_files[batch_dict[key]['file']], batch_dict[key]['indices'])
+                       for key in list(batch_dict)[task::n_tasks]] for task in range(n_tasks)]
+        def run(bins):
+            func_args = [(task_batches, cuts, n_classes) + bins for task_batches in batches]
+            if n_tasks > 1:
+                with mp.Pool(n_tasks) as pool: return pool.map(weight_batches, func_args)
+            return [weight_batches(arg) for arg in func_args]
+        ranges = [n for n in run((None, None)) if n is not None]
+        pt_min, eta_min = np.min([n[0] for n in ranges], axis=0); pt_max, eta_max = np.max([n[1] for n in ranges], axis=0)
+        #same bins as get_sample_weights before merging
+        pt_bins  = np.logspace(np.log10(np.float64(pt_min)), np.log10(np.float64(pt_max)), num=101)
+        pt_bins[0], pt_bins[-1] = pt_min, np.float64(pt_max)+1e-3
+        n_bins   = 50; step = eta_max/n_bins
+        eta_bins = np.arange(eta_min, eta_max+step, step)
+        eta_bins[-1] = max(eta_bins[-1], eta_max) + 1e-3
+        hist_data = {'counts':np.sum(run((pt_bins, eta_bins)), axis=0), 'pt_bins':pt_bins, 'eta_bins':eta_bins,
+                     'compo':add_compo([n[2] for n in ranges])}
+        if hist_file is not None: np.savez(hist_file, key=hist_key, **hist_data)
+    counts, pt_bins, eta_bins = hist_data['counts'], hist_data['pt_bins'], hist_data['eta_bins']
+    #classes of the sample and underpopulated pt bins merged as in get_bins
+    counts = counts[:np.max(np.nonzero(np.sum(counts, axis=(1,2))))+1]
+    keep   = merge_bins(np.sum(counts, axis=(0,2)), 1)
+    for class_counts in np.sum(counts, axis=2):
+        if np.sum(class_counts) != 0: keep = merge_bins(class_counts, 1, keep)
+    pt_bins, counts = pt_bins[keep], np.add.reduceat(counts, keep[:-1], axis=1)
+    print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+    return counts, {'pt':pt_bins, 'eta':eta_bins}, hist_data['compo']
+def hist_weights(counts, bins, weight_type=None, bkg_ratio=None, hist='2d', ref_class=0, density=False):
+    #weights table of get_sample_weights from the per-class histograms of stream_hists
+    pt_bins, eta_bins = bins['pt'], bins['eta']
+    if weight_type not in ['bkg_ratio', 'flat', 'match2class', 'match2max']: return None, bins
+    if hist == 'pt' : eta_bins, counts = [eta_bins[0], eta_bins[-1]], np.sum(counts, axis=2, keepdims=True)
+    if hist == 'eta':  pt_bins, counts = [ pt_bins[0],  pt_bins[-1]], np.sum(counts, axis=1, keepdims=True)
+    table = weight_table(np.float64(counts), pt_bins, eta_bins, weight_type, bkg_ratio, ref_class, density)
+    return table, {'pt':np.asarray(pt_bins), 'eta':np.asarray(eta_bins)}
+def weight_batches(func_args):
+    #(pt, |eta|) ranges and composition of the batches without bins, per-class counts on the bins otherwise
+    batches, cuts, n_classes, pt_bins, eta_bins = func_args
+    cuts = Cuts(cuts); ranges = []; compos = []; counts = 0
+    for data_file, idx in batches:
+        mask   = cut_mask(data_file, idx, n_classes, cuts)[1]
+        sample, labels = make_sample(data_file, idx, {'scalars':[], 'images':[], 'others':['p_et_calo', 'p_eta']
+                                     +label_keys}, 0, n_classes, mask=mask, lazy=True)
+        pt, eta = sample['pt'], np.abs(sample['eta'])
+        if len(labels) == 0: continue
+        if pt_bins is None:
+            ranges += [[(np.min(pt), np.min(eta)), (np.max(pt), np.max(eta))]]
+            compos += [compo_counts(sample)]; continue
+        n_pt, n_eta = len(pt_bins)-1, len(eta_bins)-1
+        bins    = (np.int64(labels)*n_pt + bin_index(pt_bins, pt))*n_eta + bin_index(eta_bins, eta)
+        counts += np.bincount(bins, minlength=n_classes*n_pt*n_eta).reshape(n_classes, n_pt, n_eta)
+    if pt_bins is None:
+        return None if len(ranges) == 0 else [np.min([n[0] for n in ranges], axis=0),
+                                              np.max([n[1] for n in ranges], axis=0), add_compo(compos)]
+    return counts if np.ndim(counts) != 0 else np.zeros((n_classes, len(pt_bins)-1, len(eta_bins)-1), dtype=int)
+def count_sample(counts, bins, table=None):
+    #(pt, eta) bin centres of the histograms weighted by their counts (and table weights), as a sample for the
+    #histograms plots of var_histogram
+    pt_bins, eta_bins = np.asarray(bins['pt']), np.asarray(bins['eta'])
+    labels, pt_idx, eta_idx = [n.ravel() for n in np.indices(counts.shape)]
+    sample  = {'pt':(pt_bins[:-1]+pt_bins[1:])[pt_idx]/2, 'eta':(eta_bins[:-1]+eta_bins[1:])[eta_idx]/2}
+    weights = np.float64(counts.ravel())
+    if table is not None: weights *= table(sample, labels)
+    return sample, labels, weights
 
 
 def upsampling(sample, labels, bins, indices, hist_sig, hist_bkg, total_sig, total_bkg):
     new_sig = np.int_(np.around(total_sig)) - hist_sig
     new_bkg = np.int_(np.around(total_bkg)) - hist_bkg
-    ind_sig = [np.where((indices==n) & (labels==0))[0] for n in np.arange(len(bins)-1)]
-    ind_bkg = [np.where((indices==n) & (labels!=0))[0] for n in np.arange(len(bins)-1)]
-    np.random.seed(0)
-    ind_sig = [np.append(ind_sig[n], np.random.choice(ind_sig[n], new_sig[n],
-               replace = len(ind_sig[n])<new_sig[n])) for n in np.arange(len(bins)-1)]
-    ind_bkg = [np.append(ind_bkg[n], np.random.choice(ind_bkg[n], new_bkg[n],
-               replace = len(ind_bkg[n])<new_bkg[n])) for n in np.arange(len(bins)-1)]
-    indices = np.concatenate(ind_sig + ind_bkg); np.random.shuffle(indices)
+    indices = upsampling_indices(labels, indices, new_sig, new_bkg); np.random.shuffle(indices)
     return {key:np.take(sample[key], indices, axis=0) for key in sample}, np.take(labels, indices)
 
 
 def downsampling(sample, labels, bkg_ratio=None):
-    pt = sample['p_et_calo']; bins = [0, 10, 20, 30, 40, 60, 80, 100, 130, 180, 250, 500]
-    indices  = np.digitize(pt, bins, right=True) -1
-    hist_sig = np.histogram(pt[labels==0], bins)[0]
-    hist_bkg = np.histogram(pt[labels!=0], bins)[0]
-    if bkg_ratio == None: bkg_ratio = np.sum(hist_bkg)/np.sum(hist_sig)
-    total_sig = np.int_(np.around(np.minimum(hist_sig, hist_bkg/bkg_ratio)))
-    total_bkg = np.int_(np.around(np.minimum(hist_bkg, hist_sig*bkg_ratio)))
-    ind_sig   = [np.where((indices==n) & (labels==0))[0][:total_sig[n]] for n in np.arange(len(bins)-1)]
-    ind_bkg   = [np.where((indices==n) & (labels!=0))[0][:total_bkg[n]] for n in np.arange(len(bins)-1)]
-    valid_ind = np.concatenate(ind_sig+ind_bkg); np.random.seed(0); np.random.shuffle(valid_ind)
-    train_ind = list(set(np.arange(len(pt))) - set(valid_ind))
+    valid_ind, train_ind = downsampling_indices(sample['p_et_calo'], labels, bkg_ratio)
+    np.random.seed(0); np.random.shuffle(valid_ind)
     valid_sample = {key:np.take(sample[key], valid_ind, axis=0) for key in sample}
     valid_labels = np.take(labels, valid_ind)
     extra_sample = {key:np.take(sample[key], train_ind, axis=0) for key in sample}
@@ -169,54 +250,334 @@ def get_dataset(input_path='', input_dir='', host_name='lps'):
         midgap_files = sorted([midgap_dir+'/'+h5_file for h5_file in os.listdir(midgap_dir) if 'e-ID_' in h5_file])
         endcap_files = sorted([endcap_dir+'/'+h5_file for h5_file in os.listdir(endcap_dir) if 'e-ID_' in h5_file])
         data_files = [h5_file for group in zip(barrel_files, midgap_files, endcap_files) for h5_file in group]
+    get_manifest(data_files)
     return data_files
 
 
-def make_sample(data_file, idx, input_data, n_tracks, n_classes, verbose='OFF', prefix='p_', preprocess=False):
+# Per-folder cache of HDF5 metadata (row counts, keys, shapes, dtypes, chunks), rebuilt for modified files only
+manifest_cache = {}
+def get_manifest(data_files, manifest_file='.manifest.pkl', verbose='ON'):
+    manifest = {}
+    for folder in sorted(set([os.path.dirname(h5_file) for h5_file in data_files])):
+        if folder not in manifest_cache:
+            try: manifest_cache[folder] = pickle.load(open(folder+'/'+manifest_file, 'rb'))
+            except (OSError, EOFError, pickle.UnpicklingError): manifest_cache[folder] = {}
+        entries = manifest_cache[folder]
+        h5_files = [h5_file for h5_file in data_files if os.path.dirname(h5_file) == folder]
+        stats    = {h5_file:os.stat(h5_file) for h5_file in h5_files}
+        outdated = [h5_file for h5_file in h5_files if os.path.basename(h5_file) not in entries
+                    or entries[os.path.basename(h5_file)]['mtime'] != stats[h5_file].st_mtime
+                    or entries[os.path.basename(h5_file)]['size' ] != stats[h5_file].st_size ]
+        if len(outdated) != 0:
+            if verbose == 'ON':
+                print('Building manifest for', len(outdated), 'file(s) in', folder, end=' --> ', flush=True)
+                start_time = time.time()
+            for h5_file in outdated: entries[os.path.basename(h5_file)] = h5_manifest(h5_file, stats[h5_file])
+            if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+            try:
+                temp_file = folder+'/'+manifest_file+'.'+str(os.getpid())
+                with open(temp_file, 'wb') as pkl: pickle.dump(entries, pkl)
+                os.replace(temp_file, folder+'/'+manifest_file)
+            except OSError: pass
+        manifest.update({h5_file:entries[os.path.basename(h5_file)] for h5_file in h5_files})
+    return {h5_file:manifest[h5_file] for h5_file in data_files}
+def h5_manifest(h5_file, stat):
+    entry = {'mtime':stat.st_mtime, 'size':stat.st_size, 'datasets':{}}
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            entry['datasets'][name] = {'shape':obj.shape, 'dtype':obj.dtype.str, 'chunks':obj.chunks,
+                                       'compression':obj.compression}
+    #read outside of h5_pool since the pool sizes its chunk caches from the manifest
+    with h5py.File(h5_file, 'r') as data:
+        data.visititems(visit)
+        #external links (datasets of prescaled files) are not followed by visititems
+        for key in [key for key in data if isinstance(data.get(key, getlink=True), h5py.ExternalLink)]:
+            visit(key, data[key])
+            if isinstance(data[key], h5py.Group): data[key].visititems(lambda name, obj: visit(key+'/'+name, obj))
+        entry['keys']   = list(data.keys())
+        entry['attrs']  = dict(data.attrs)
+        entry['groups'] = {key:len(data[key]['eventNumber']) for key in data
+                           if isinstance(data[key], h5py.Group) and 'eventNumber' in data[key]}
+    entry['n_e'] = entry['datasets']['eventNumber']['shape'][0] if 'eventNumber' in entry['datasets'] else 0
+    return entry
+def manifest_sample(data_file, input_data, n_tracks, prefix='p_'):
+    #empty sample with the shapes and dtypes of make_sample outputs, for model creation
+    datasets = get_manifest([data_file], verbose='OFF')[data_file]['datasets']
+    scalars, images, others = input_data.values(); sample = {}
+    for key in set(scalars+images+others)-{'tracks'}:
+        if   key in datasets: sample[key] = np.zeros((0,)+datasets[key]['shape'][1:], dtype=datasets[key]['dtype'])
+        elif key in images  : sample[key] = np.zeros((0,)+((56,11) if 'fine' in key else (7,11)))
+    if 'tracks' in scalars+images:
+        shape = datasets[prefix+'tracks']['shape']
+        sample['tracks'] = np.zeros((0, min(n_tracks, shape[1]), min(13, shape[2])),
+                                    dtype=np.float32 if images==['tracks'] else datasets[prefix+'tracks']['dtype'])
+    if tf.__version__ < '2.1.0':
+        for key in set(sample)-set(others): sample[key] = np.float32(sample[key])
+    return sample
+
+
+def make_sample(data_file, idx, input_data, n_tracks, n_classes, verbose='OFF', prefix='p_', preprocess=False,
+                mask=None, out=None, lazy=False):
+    #mask: optional selection of the rows to read (from cut_mask)
+    #out : optional preallocated arrays (from sample_buffers) that are filled in place
+    #lazy: returns a Lazy_Sample whose columns are only read when first accessed
     scalars, images, others = input_data.values()
     if verbose == 'ON':
         print('Loading sample [', format(str(idx[0]),'>8s')+', '+format(str(idx[1]),'>8s'), end='] ')
         print('from', data_file.split('/')[-2]+'/'+data_file.split('/')[-1], end=' --> ', flush=True)
         start_time = time.time()
-    with h5py.File(data_file, 'r') as data:
-        sample = {key:data[key][idx[0]:idx[1]] for key in set(scalars+others)-{'tracks'}}
-        sample.update({'eta'      :sample['p_eta'], 'pt':sample['p_et_calo'],
-                       'mu'       :sample['averageInteractionsPerCrossing' ],
-                       'SCTHits'  :sample['p_numberOfSCTHits'              ],
-                       'PixelHits':sample['p_numberOfPixelHits'            ],
-                       'BLHits'   :sample['p_numberOfInnermostPixelHits'   ]})
+    if lazy:
+        sample = Lazy_Sample([(data_file, idx, mask)], input_data, n_tracks, prefix)
+        labels = make_labels(sample, n_classes)
+        if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+        if preprocess and images != []: sample = process_images(sample, images, verbose)
+        return sample, labels
+    n_e = idx[1]-idx[0] if mask is None else np.sum(mask)
+    if out is None: out = sample_buffers(data_file, n_e, input_data, n_tracks, prefix)
+    data = h5_pool.open(data_file)
+    #missing images are left to the zeros of the buffers
+    for key in [key for key in out if key in data and key != 'tracks']:
+        read_rows(data[key], idx, out[key], mask=mask)
+    sample = with_aliases({key:out[key] for key in out})
+    '''
+    if len(images) != 0:
+    #    energy = sum([np.maximum(sample[key], 0) for key in set(images)-{'tracks'} if 'fine' not in key])
+    #    energy = np.sum(energy, axis=(1,2))
+    #    energy = np.where(energy==0, 1, energy)
+    #    for key in set(images)-{'tracks'}:
+    #        sample[key] = np.maximum(sample[key],0) / energy[:,np.newaxis,np.newaxis]
+        energy = sum([sample[key] for key in set(images)-{'tracks'} if 'fine' not in key])
+        energy = np.sum(energy, axis=(1,2))
+        energy = np.where(energy==0, 1, energy)
         for key in set(images)-{'tracks'}:
-            try:
-                sample[key] = data[key][idx[0]:idx[1]]
-            except KeyError:
-                if 'fine' in key: sample[key] = np.zeros((idx[1]-idx[0],)+(56,11))
-                else            : sample[key] = np.zeros((idx[1]-idx[0],)+( 7,11))
-        '''
-        if len(images) != 0:
-        #    energy = sum([np.maximum(sample[key], 0) for key in set(images)-{'tracks'} if 'fine' not in key])
-        #    energy = np.sum(energy, axis=(1,2))
-        #    energy = np.where(energy==0, 1, energy)
-        #    for key in set(images)-{'tracks'}:
-        #        sample[key] = np.maximum(sample[key],0) / energy[:,np.newaxis,np.newaxis]
-            energy = sum([sample[key] for key in set(images)-{'tracks'} if 'fine' not in key])
-            energy = np.sum(energy, axis=(1,2))
-            energy = np.where(energy==0, 1, energy)
-            for key in set(images)-{'tracks'}:
-                sample[key] = sample[key] / energy[:,np.newaxis,np.newaxis]
-        '''
-        if 'tracks' in scalars+images:
-            n_tracks    = min(n_tracks, data[prefix+'tracks'].shape[1])
-            tracks_data = data[prefix+'tracks'][idx[0]:idx[1]][:,:n_tracks,:]
-            tracks_data = np.concatenate((abs(tracks_data[...,0:5]), tracks_data[...,5:13]), axis=2)
-            #tracks_data = np.concatenate((abs(tracks_data[...,0:5]), tracks_data[...,5:6], tracks_data[...,7:13]), axis=2)
-            sample['tracks'] = tracks_data
-    if tf.__version__ < '2.1.0':
-        for key in set(sample)-set(others): sample[key] = np.float32(sample[key])
-    if images == ['tracks']: sample['tracks'] = np.float32(sample['tracks'])
+            sample[key] = sample[key] / energy[:,np.newaxis,np.newaxis]
+    '''
+    if 'tracks' in scalars+images:
+        tracks_data = sample['tracks']
+        read_rows(data[prefix+'tracks'], idx, tracks_data, np.s_[:tracks_data.shape[1],:tracks_data.shape[2]], mask)
+        np.abs(tracks_data[...,0:5], out=tracks_data[...,0:5])
+        #tracks_data = np.concatenate((abs(tracks_data[...,0:5]), tracks_data[...,5:6], tracks_data[...,7:13]), axis=2)
     labels = make_labels(sample, n_classes)
     if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
     if preprocess and images != []: sample = process_images(sample, images, verbose)
     return sample, labels
+def sample_buffers(data_file, n_e, input_data, n_tracks, prefix='p_', allocate=np.zeros):
+    sample = manifest_sample(data_file, input_data, n_tracks, prefix)
+    return {key:allocate((n_e,)+sample[key].shape[1:], dtype=sample[key].dtype) for key in sample}
+def read_rows(dataset, idx, array, selection=(), mask=None, block_size=2**26):
+    #decompresses rows idx[0]:idx[1] of an HDF5 dataset directly into an existing array
+    #with a row mask, only selected rows are stored and chunks without any selected row are never read
+    if idx[1] <= idx[0]: return
+    if block_cache is not None: return block_cache.read_rows(dataset, idx, array, selection, mask)
+    if mask is None: dataset.read_direct(array, (slice(idx[0],idx[1]),) + selection); return
+    chunk  = dataset.chunks[0] if dataset.chunks is not None else idx[1]-idx[0]
+    ends   = np.append(np.arange((idx[0]//chunk+1)*chunk, idx[1], chunk), idx[1])
+    starts = np.append(idx[0], ends[:-1])
+    counts = np.add.reduceat(mask, starts-idx[0], dtype=np.int64)
+    max_e  = max(chunk, block_size//max(1, array[:1].nbytes)); runs = []
+    for start, end in zip(starts[counts!=0], ends[counts!=0]):
+        if len(runs) != 0 and runs[-1][1] == start and end-runs[-1][0] <= max_e: runs[-1][1] = end
+        else: runs += [[start, end]]
+    n_rows = 0
+    for start, end in runs:
+        rows = mask[start-idx[0]:end-idx[0]]; n_e = np.sum(rows)
+        if n_e == end-start: dataset.read_direct(array, (slice(start,end),) + selection, np.s_[n_rows:n_rows+n_e])
+        else               : array[n_rows:n_rows+n_e] = dataset[(slice(start,end),) + selection][rows]
+        n_rows += n_e
+
+
+def read_column(dataset, idx):
+    array = np.empty((idx[1]-idx[0],)+dataset.shape[1:], dtype=dataset.dtype)
+    read_rows(dataset, idx, array); return array
+
+
+block_cache = None
+def init_block_cache(cache_dir=None, max_size=100e9):
+    #decoded blocks are cached on node-local disk (SLURM_TMPDIR by default) for all subsequent reads
+    global block_cache
+    if cache_dir is None: cache_dir = os.path.join(os.environ.get('SLURM_TMPDIR', '/tmp'), 'e-ID_cache')
+    block_cache = Block_Cache(cache_dir, max_size)
+    return block_cache
+
+
+class H5_Pool:
+    #per-process pool of read-only HDF5 handles keyed by path, kept open between reads so that superblocks, B-trees
+    #and raw chunk caches are reused; handles inherited through fork are dropped and the files reopened in the child
+    #each dataset read gets a raw chunk cache sized to its own chunks, and the caches of the least recently used
+    #datasets are released once those of all the datasets read exceed max_cache bytes
+    def __init__(self, max_cache=4e9):
+        self.handles = {}; self.pid = os.getpid(); self.hits = 0; self.misses = 0
+        self.max_cache = max_cache; self.datasets = {}; self.clock = 0
+    def open(self, file_name):
+        if os.getpid() != self.pid:
+            self.handles, self.datasets, self.pid, self.hits, self.misses = {}, {}, os.getpid(), 0, 0
+        if file_name in self.handles and self.handles[file_name].id.valid: self.hits += 1
+        else: self.handles[file_name] = h5py.File(file_name, 'r'); self.misses += 1
+        return H5_File(self, self.handles[file_name])
+    def dataset(self, data, key):
+        #datasets are reopened with their own chunk cache, other objects are returned as they are
+        self.clock += 1; name = (data.filename, key)
+        if name in self.datasets and self.datasets[name][0].id.valid:
+            self.datasets[name][2] = self.clock; return self.datasets[name][0]
+        #an open dataset keeps the cache it was opened with, so the chunks are read from a first handle that is
+        #dropped before the dataset is reopened with its own cache
+        dataset = data[key]
+        if not isinstance(dataset, h5py.Dataset) or dataset.chunks is None: return dataset
+        chunk_bytes = np.prod(dataset.chunks)*dataset.dtype.itemsize; del dataset
+        settings = rdcc_args([chunk_bytes])
+        dapl     = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+        dapl.set_chunk_cache(settings['rdcc_nslots'], settings['rdcc_nbytes'], settings['rdcc_w0'])
+        dataset  = h5py.Dataset(h5py.h5d.open(data.id, key.encode(), dapl))
+        self.datasets[name] = [dataset, settings['rdcc_nbytes'], self.clock]; self.release()
+        return dataset
+    def release(self):
+        #the caches are freed when the last reference to a released dataset is dropped
+        datasets = sorted(list(self.datasets.items()), key=lambda item: item[1][2])
+        footprint = sum([item[1][1] for item in datasets])
+        for name, (_, nbytes, _) in datasets[:-1]:
+            if footprint <= self.max_cache: break
+            self.datasets.pop(name, None); footprint -= nbytes
+    def close(self, file_name=None):
+        for name in list(self.handles) if file_name is None else [file_name]:
+            for key in [key for key in list(self.datasets) if key[0] == name]: self.datasets.pop(key, None)
+            if name in self.handles and os.getpid() == self.pid: self.handles[name].close()
+            self.handles.pop(name, None)
+    def stats(self):
+        hit_rates = [data.id.get_mdc_hit_rate() for data in self.handles.values() if data.id.valid]
+        return {'open':len(self.handles), 'hits':self.hits, 'misses':self.misses, 'datasets':len(self.datasets),
+                'rdcc_bytes':sum([item[1] for item in list(self.datasets.values())]),
+                'mdc_hit_rate':np.mean(hit_rates) if hit_rates != [] else None}
+class H5_File:
+    #h5py file of the pool whose datasets are opened through H5_Pool.dataset
+    def __init__(self, pool, data):
+        self.pool = pool; self.data = data
+    def __getitem__(self, key):
+        return self.pool.dataset(self.data, key)
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+    def __contains__(self, key):
+        return key in self.data
+    def __iter__(self):
+        return iter(self.data)
+    def __len__(self):
+        return len(self.data)
+def rdcc_args(chunk_bytes, max_nbytes=2**30):
+    #sequential reads keep the chunks at a batch edge for the next read of the same dataset;
+    #nslots is a prime about 100 times the number of cached chunks
+    if len(chunk_bytes) == 0: return {}
+    nbytes = int(min(max(2*max(chunk_bytes), 2**20), max_nbytes))
+    nslots = int(100*max(1, nbytes//min(chunk_bytes)) + 1)
+    while any(nslots % n == 0 for n in range(2, int(nslots**0.5)+1)): nslots += 2
+    return {'rdcc_nbytes':nbytes, 'rdcc_nslots':nslots, 'rdcc_w0':1.}
+h5_pool = H5_Pool()
+atexit.register(h5_pool.close)
+
+
+class Block_Cache:
+    #uncompressed column blocks stored as .npy files keyed by file, column and row range, and memory-mapped on
+    #later reads; blocks are aligned to the HDF5 chunks and the least recently used ones are evicted past max_size
+    def __init__(self, cache_dir, max_size=100e9, block_size=2**26, max_rows=2**20):
+        self.cache_dir = cache_dir; self.max_size = max_size; self.block_size = block_size
+        self.max_rows  = max_rows ; self.stats    = {}      ; self.hits = 0; self.misses = 0
+        self.size      = None #running size of the cache, rescanned only when past max_size
+        os.makedirs(cache_dir, exist_ok=True)
+    def read_rows(self, dataset, idx, array, selection=(), mask=None):
+        chunk    = dataset.chunks[0] if dataset.chunks is not None else 1
+        row_size = max(1, dataset.dtype.itemsize*int(np.prod(dataset.shape[1:])))
+        n_rows   = chunk*max(1, min(self.block_size//row_size, self.max_rows)//chunk); n_e = 0
+        for start in range(idx[0]//n_rows*n_rows, idx[1], n_rows):
+            low, high = max(start, idx[0]), min(start+n_rows, idx[1])
+            rows = slice(None) if mask is None else mask[low-idx[0]:high-idx[0]]
+            size = high-low    if mask is None else np.sum(rows)
+            if size == 0: continue
+            block = self.block(dataset, start, min(start+n_rows, len(dataset)))
+            array[n_e:n_e+size] = block[(slice(low-start,high-start),) + selection][rows]
+            n_e += size
+    def block(self, dataset, start, end):
+        file_name = os.path.realpath(dataset.file.filename)
+        if file_name not in self.stats:
+            stat = os.stat(file_name); self.stats[file_name] = (stat.st_mtime, stat.st_size)
+        key  = repr((file_name, self.stats[file_name], dataset.name, start, end))
+        path = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest()+'.npy')
+        try:
+            block = np.load(path, mmap_mode='r'); os.utime(path); self.hits += 1
+            return block
+        except (OSError, ValueError): pass
+        block = dataset[start:end]; self.misses += 1
+        tmp_file = path+'.'+str(os.getpid())+'.tmp'
+        try:
+            with open(tmp_file, 'wb') as output: np.save(output, block)
+            size = os.path.getsize(tmp_file); os.replace(tmp_file, path)
+            if self.size is None or self.size+size > self.max_size: self.evict()
+            else: self.size += size
+        except OSError:
+            if os.path.isfile(tmp_file): os.remove(tmp_file)
+        return block
+    def evict(self, fill=0.9):
+        #blocks written by other processes are only counted here, so the cache is brought down to fill*max_size
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat(); files += [(stat.st_mtime, stat.st_size, entry.path)]
+            except OSError: pass
+        total_size = sum([size for _, size, _ in files])
+        for _, size, path in sorted(files) if total_size > self.max_size else []:
+            if total_size <= fill*self.max_size: break
+            try: os.remove(path); total_size -= size
+            except OSError: pass
+        self.size = total_size
+
+
+class Lazy_Sample(MutableMapping):
+    #dict-like sample whose columns are decompressed from open HDF5 files on first access and then cached
+    #sources: list of (data_file, idx, mask) concatenated in order, with mask=None for all rows of idx
+    #missing images are read-only zero-strided arrays that allocate no memory
+    def __init__(self, sources, input_data, n_tracks, prefix='p_'):
+        self.sources   = sources ; self.prefix  = prefix
+        self.templates = manifest_sample(sources[0][0], input_data, n_tracks, prefix)
+        self.n_e       = sum([np.diff(idx)[0] if mask is None else np.sum(mask) for _, idx, mask in sources])
+        self.names     = list(self.templates) + [key for key in sample_aliases if sample_aliases[key] in self.templates]
+        self.columns   = {}; self.raw = set()
+    def __getitem__(self, key):
+        if key in self.columns: return self.columns[key]
+        if key not in self.names: raise KeyError(key)
+        base = sample_aliases[key] if key in sample_aliases and key not in self.templates else key
+        #aliases share the raw column and keep it even if the base key is later reassigned (e.g. scaling)
+        if base not in self.raw:
+            column = self.load(base)
+            if base in self.columns: self.columns[key] = column; return column
+            self.columns[base] = column; self.raw.add(base)
+        self.columns[key] = self.columns[base]
+        return self.columns[key]
+    def __setitem__(self, key, value):
+        self.columns[key] = value; self.raw.discard(key)
+        if key not in self.names: self.names.append(key)
+    def __delitem__(self, key):
+        self.names.remove(key); self.columns.pop(key, None); self.raw.discard(key)
+    def __iter__(self):
+        return iter(list(self.names))
+    def __len__(self):
+        return len(self.names)
+    def __reduce__(self):
+        return dict, ({key:self[key] for key in self},)
+    def load(self, key):
+        template = self.templates[key]; shape = (self.n_e,)+template.shape[1:]
+        dataset  = self.prefix+'tracks' if key == 'tracks' else key
+        if not any(dataset in self.handle(data_file) for data_file, _, _ in self.sources):
+            return np.broadcast_to(np.zeros((), dtype=template.dtype), shape)
+        array = np.empty(shape, dtype=template.dtype); offset = 0
+        selection = np.s_[:shape[1],:shape[2]] if key == 'tracks' else ()
+        for data_file, idx, mask in self.sources:
+            n_e = np.diff(idx)[0] if mask is None else np.sum(mask)
+            if dataset in self.handle(data_file):
+                read_rows(self.handle(data_file)[dataset], idx, array[offset:offset+n_e], selection, mask)
+            else: array[offset:offset+n_e] = 0
+            offset += n_e
+        if key == 'tracks': np.abs(array[...,0:5], out=array[...,0:5])
+        return array
+    def handle(self, data_file):
+        return h5_pool.open(data_file)
 
 
 def make_labels(sample, n_classes, data_LF=False, match_to_vertex=False):
@@ -274,75 +635,516 @@ def make_labels(sample, n_classes, data_LF=False, match_to_vertex=False):
     return np.int8(labels)
 
 
-def batch_idx(data_files, batch_size, interval, weights=None, shuffle='OFF'):
-    def return_idx(n_e, cum_batches, batch_size, index):
-        file_index  = np.searchsorted(cum_batches, index, side='right')
-        batch_index = index - np.append(0, cum_batches)[file_index]
-        idx         = batch_index*batch_size; idx = [idx, min(idx+batch_size, n_e[file_index])]
-        return file_index, idx
-    n_e = [len(h5py.File(data_file,'r')['eventNumber']) for data_file in data_files]
-    cum_batches = np.cumsum(np.int_(np.ceil(np.array(n_e)/batch_size)))
-    indexes     = [return_idx(n_e, cum_batches, batch_size, index) for index in np.arange(cum_batches[-1])]
-    cum_n_e     = np.cumsum(np.diff(list(zip(*indexes))[1]))
-    n_e_index   = np.searchsorted(cum_n_e, [interval[0],interval[1]-1], side='right')
-    batch_list  = [indexes[n] for n in np.arange(cum_batches[-1]) if n >= n_e_index[0] and n <= n_e_index[1]]
-    cum_n_e     = [cum_n_e[n] for n in np.arange(cum_batches[-1]) if n >= n_e_index[0] and n <= n_e_index[1]]
-    batch_list[ 0][1][0] = batch_list[ 0][1][1] + interval[0] - cum_n_e[ 0]
-    batch_list[-1][1][1] = batch_list[-1][1][1] + interval[1] - cum_n_e[-1]
-    if shuffle == 'ON': batch_list = utils.shuffle(batch_list, random_state=0)
-    batch_dict = {batch_list.index(n):{'file':n[0], 'indices':n[1], 'weights':None} for n in batch_list}
-    if np.all(weights) != None:
-        weights = np.split(weights, np.cumsum(n_e))
-        for n in batch_list: batch_dict[batch_list.index(n)]['weights'] = weights[n[0]][n[1][0]:n[1][1]]
+def batch_idx(data_files, batch_size, interval, shuffle='OFF', align='OFF', verbose='OFF', keys=None):
+    #align='ON' rounds the batch size to whole chunks of the datasets read (keys) so that batches are cut on the
+    #on-disk chunk grid, shuffle='block' shuffles the batches as contiguous row groups and shuffle='stream' leaves
+    #them in order for the per-epoch shuffle of Batch_Generator
+    manifest   = get_manifest(data_files, verbose='OFF')
+    n_e        = [manifest[data_file]['n_e'] for data_file in data_files]
+    chunk_size = [chunk_rows(manifest[data_file], keys) for data_file in data_files]
+    batch_list = []; start = 0; steps = set()
+    for file_index in np.arange(len(data_files)):
+        if align == 'ON': step = max(1, int(round(batch_size/chunk_size[file_index])))*chunk_size[file_index]
+        else            : step = batch_size
+        steps.add(int(step))
+        edges = np.append(np.arange(0, n_e[file_index], step), n_e[file_index])
+        for idx in zip(edges[:-1], edges[1:]):
+            idx = [int(max(idx[0], interval[0]-start)), int(min(idx[1], interval[1]-start))]
+            if idx[0] < idx[1]: batch_list += [(int(file_index), idx)]
+        start += n_e[file_index]
+    if shuffle in ['ON', 'block']: batch_list = utils.shuffle(batch_list, random_state=0)
+    batch_dict = {index:{'file':n[0], 'indices':n[1],
+                         'chunks':n_chunks(n[1], chunk_size[n[0]])} for index,n in enumerate(batch_list)}
+    if verbose == 'ON':
+        file_idx   = {}
+        for n in batch_list:
+            idx = file_idx.get(n[0], n[1]); file_idx[n[0]] = [min(idx[0], n[1][0]), max(idx[1], n[1][1])]
+        min_chunks = sum([n_chunks(file_idx[n], chunk_size[n]) for n in file_idx])
+        print('Batch planner:', len(batch_dict), 'batches decompressing', end=' ')
+        print(sum([batch_dict[n]['chunks'] for n in batch_dict]), 'chunks per dataset per epoch', end=' ')
+        print('(' + str(min_chunks), 'chunks in range)')
+        if steps != {batch_size}: print('Batch planner: batch size', batch_size, '-->', sorted(steps), 'on chunk grid')
     #for key in batch_dict: print(key, batch_dict[key])
     return batch_dict
+def chunk_rows(manifest_entry, keys=None):
+    #largest chunk rows of the datasets read (all if keys is None)
+    chunks = [val['chunks'][0] for key, val in manifest_entry['datasets'].items()
+              if val['chunks'] is not None and (keys is None or key in keys)]
+    return int(max(chunks)) if len(chunks) != 0 else 1
+def n_chunks(idx, chunk_size):
+    return int(np.ceil(idx[1]/chunk_size) - idx[0]//chunk_size)
+
+
+def merge_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, scaler=None, t_scaler=None, n_tasks=None,
+                  lazy=False, host_dtype=None, shared=False):
+    #shared: the unscaled sample is loaded once per node into shared memory and attached by the other processes
+    if shared and not lazy:
+        sample, labels, indices = shared_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, n_tasks)
+    else:
+        sample, labels, indices = load_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, n_tasks, lazy)
+    if   scaler != None: sample = apply_scaler(sample, input_data['scalars'], scaler, verbose='ON',
+                                               dtype=np.float32 if host_dtype is None else host_dtype)
+    if t_scaler != None: sample = apply_t_scaler(sample, t_scaler, verbose='ON', dtype=host_dtype)
+    else: print()
+    if host_dtype is not None and not lazy:
+        sample = host_cast(sample, input_data['scalars']+input_data['images'], host_dtype)
+    return sample, labels, indices
 
 
-def merge_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, scaler=None, t_scaler=None):
-    batch_dict = batch_idx(data_files, np.diff(idx)[0], idx)
-    samples, labels = zip(*[make_sample(data_files[batch_dict[key]['file']], batch_dict[key]['indices'],
-                            input_data, n_tracks, n_classes, verbose='ON') for key in batch_dict])
-    labels = np.concatenate(labels); sample = {}
-    for key in list(samples[0].keys()):
-        sample[key] = np.concatenate([n[key] for n in samples])
-        for n in samples: n.pop(key)
-    cut_list = [np.full_like(labels, True, dtype=bool)]
-    for cut in cuts:
-        try   : cut_list.append(eval(cut))
-        except: pass
-    eval_cuts = np.logical_and.reduce(cut_list)
-    indices = np.where( np.logical_and(labels!=-1, eval_cuts if cuts!='' else True) )[0]
-    sample, labels, _ = sample_cuts(sample, labels, cuts=cuts, verbose='ON')
-    if   scaler != None: sample = apply_scaler(sample, input_data['scalars'], scaler, verbose='ON')
-    if t_scaler != None: sample = apply_t_scaler(sample, t_scaler, verbose='ON')
-    else: print()
+def load_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, n_tasks=None, lazy=False, allocate=None):
+    #with several processes, each file range is split into chunk-aligned blocks to balance the workload
+    n_tasks    = get_n_tasks(n_tasks)
+    batch_size = int(np.ceil(np.diff(idx)[0]/n_tasks))
+    batch_dict = batch_idx(data_files, batch_size, idx, align='ON' if n_tasks > 1 else 'OFF')
+    buffers    = shared_array if n_tasks > 1 else np.zeros
+    offsets    = np.cumsum([0]+[np.diff(batch_dict[key]['indices'])[0] for key in batch_dict])
+    #first pass: row selection from the label and cut columns only
+    cuts, manifest = Cuts(cuts), get_manifest(data_files, verbose='OFF')
+    for cut in set(sum([cuts.missing(manifest[data_file]['keys']) for data_file in data_files], [])):
+        print('WARNING --> cut skipped (missing column):', cut)
+    print('Selecting', np.diff(idx)[0], 'e from label and cut columns', end=' --> ', flush=True)
+    start_time = time.time()
+    masks      = buffers(np.diff(idx)[0], dtype=bool)
+    func_args  = [(data_files[batch_dict[key]['file']], batch_dict[key]['indices'], n_classes, cuts, offsets[key])
+                  for key in batch_dict]
+    if n_tasks > 1:
+        with mp.Pool(n_tasks, initializer=init_buffers, initargs=(masks,)) as pool:
+            counts = np.sum(pool.map(fill_masks, func_args), axis=0)
+    else:
+        init_buffers(masks); counts = np.sum([fill_masks(arg) for arg in func_args], axis=0)
+    n_truth = counts[0]
+    indices = np.where(masks)[0]
+    print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+    if n_truth != len(masks):
+        print('Applying IFFtruth cuts -->', format(n_truth,'9d'), 'e conserved', end=' ')
+        print('(' + format(100*n_truth/len(masks), '.2f') + ' %)')
+    print('Applying selected cuts -->', format(len(indices),'9d') ,'e conserved', end=' ')
+    print('(' + format(100*len(indices)/max(1,n_truth),'.2f')+' %)')
+    if len(cuts) > 1: cuts.cutflow(n_truth, counts[1:])
+    if lazy:
+        sources = [(data_files[batch_dict[key]['file']], batch_dict[key]['indices'],
+                    np.array(masks[offsets[key]:offsets[key+1]])) for key in batch_dict]
+        sample  = Lazy_Sample(sources, input_data, n_tracks)
+        labels  = np.int8(make_labels(sample, n_classes))
+    else:
+        sample, labels = fill_samples(data_files, batch_dict, offsets, masks, input_data, n_tracks, n_classes,
+                                      n_tasks, allocate or buffers)
     return sample, labels, indices
 
 
+def fill_samples(data_files, batch_dict, offsets, masks, input_data, n_tracks, n_classes, n_tasks, allocate):
+    #second pass: output arrays are sized to the selected rows and only these rows are decompressed
+    sample     = sample_buffers(data_files[0], np.sum(masks), input_data, n_tracks, allocate=allocate)
+    labels     = allocate(np.sum(masks), dtype=np.int8)
+    out_idx    = np.cumsum([0]+[np.sum(masks[offsets[key]:offsets[key+1]]) for key in batch_dict])
+    func_args  = [(data_files[batch_dict[key]['file']], batch_dict[key]['indices'], input_data, n_tracks,
+                   n_classes, masks[offsets[key]:offsets[key+1]], out_idx[key]) for key in batch_dict]
+    if n_tasks > 1:
+        with mp.Pool(n_tasks, initializer=init_buffers, initargs=(sample, labels)) as pool:
+            for arg, run_time in zip(func_args, pool.imap(fill_buffers, func_args)):
+                print('Loading sample [', format(str(arg[1][0]),'>8s')+', '+format(str(arg[1][1]),'>8s'), end='] ')
+                print('from', arg[0].split('/')[-2]+'/'+arg[0].split('/')[-1], end=' --> ')
+                print('(', '\b'+format(run_time, '2.1f'), '\b'+' s)', flush=True)
+    else:
+        init_buffers(sample, labels)
+        for arg in func_args: fill_buffers(arg, verbose='ON')
+    return with_aliases(sample), labels
+def shared_samples(data_files, idx, input_data, n_tracks, n_classes, cuts, n_tasks=None, shm_dir='/dev/shm'):
+    #the first process loads the sample into .npy memory maps of a shared memory folder named after the sample
+    #arguments; other processes wait on the folder lock and attach read-only copy-free views of the same arrays
+    #clients are recorded by pid, and the last one to exit (or the next to attach after a crash) cleans up
+    manifest = get_manifest(data_files, verbose='OFF')
+    name = repr(([(os.path.realpath(data_file), manifest[data_file]['mtime'], manifest[data_file]['size'])
+                  for data_file in data_files], list(idx), input_data, n_tracks, n_classes, Cuts(cuts).cuts))
+    if not os.path.isdir(shm_dir): shm_dir = tempfile.gettempdir()
+    path = os.path.join(shm_dir, 'e-ID_'+hashlib.sha1(name.encode()).hexdigest()[:16])
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        clients = shm_clients(path) + [os.getpid()]
+        if not os.path.isfile(os.path.join(path, 'meta.pkl')):
+            for file_name in [name for name in os.listdir(path) if name.endswith('.npy')]:
+                os.remove(os.path.join(path, file_name))
+            try:
+                sample, labels, indices = load_samples(data_files, idx, input_data, n_tracks, n_classes, cuts,
+                                                       n_tasks, allocate=partial(shm_array, path))
+            except:
+                if shm_clients(path) == []: shutil.rmtree(path, ignore_errors=True)
+                raise
+            np.save(os.path.join(path, 'indices.npy'), indices)
+            meta = {'sample':{key:os.path.basename(sample[key].filename) for key in sample},
+                    'labels':os.path.basename(labels.filename), 'indices':'indices.npy'}
+            pickle.dump(meta, open(os.path.join(path, 'meta.tmp'), 'wb'))
+            os.replace(os.path.join(path, 'meta.tmp'), os.path.join(path, 'meta.pkl'))
+        else:
+            print('Attaching shared sample from', path, '('+str(len(clients))+' clients)')
+            meta = pickle.load(open(os.path.join(path, 'meta.pkl'), 'rb'))
+        with open(os.path.join(path, 'clients'), 'w') as output: output.write(' '.join(map(str, clients)))
+    atexit.register(shm_release, path, os.getpid())
+    arrays  = {file_name:np.load(os.path.join(path, file_name), mmap_mode='r')
+               for file_name in set(meta['sample'].values()) | {meta['labels'], meta['indices']}}
+    sample  = {key:arrays[meta['sample'][key]] for key in meta['sample']}
+    return sample, arrays[meta['labels']], np.array(arrays[meta['indices']])
+def shm_array(path, shape, dtype):
+    file_name = os.path.join(path, 'array_'+str(len(os.listdir(path)))+'.npy')
+    return np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=tuple(np.atleast_1d(shape).tolist()))
+def shm_clients(path):
+    try: pids = [int(pid) for pid in open(os.path.join(path, 'clients')).read().split()]
+    except OSError: return []
+    def alive(pid):
+        try: os.kill(pid, 0); return True
+        except ProcessLookupError: return False
+        except PermissionError   : return True
+    return [pid for pid in pids if alive(pid)]
+def shm_release(path, pid):
+    if os.getpid() != pid or not os.path.isdir(path): return
+    with open(os.path.join(path, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        clients = [client for client in shm_clients(path) if client != pid]
+        if clients == []: shutil.rmtree(path, ignore_errors=True)
+        else:
+            with open(os.path.join(path, 'clients'), 'w') as output: output.write(' '.join(map(str, clients)))
+def host_cast(sample, keys, dtype):
+    #reduced precision host copies of the floating point model inputs, widened per batch by widen
+    for key in [key for key in set(keys) if key in sample and np.issubdtype(sample[key].dtype, np.floating)]:
+        sample[key] = sample[key].astype(dtype, copy=False)
+    return sample
+def widen(sample, dtype=np.float32):
+    return {key:sample[key].astype(dtype) if sample[key].dtype == np.float16 else sample[key] for key in sample}
+
+
+def init_buffers(*buffers):
+    global merge_buffers; merge_buffers = buffers
+
+
+def fill_masks(func_args):
+    data_file, idx, n_classes, cuts, offset = func_args
+    truth_cut, merge_buffers[0][offset:offset+np.diff(idx)[0]] = cut_mask(data_file, idx, n_classes, cuts)
+    return np.append(np.sum(truth_cut), cuts.counts)
+
+
+def fill_buffers(func_args, verbose='OFF'):
+    data_file, idx, input_data, n_tracks, n_classes, mask, offset = func_args
+    sample, labels = merge_buffers; start_time = time.time(); n_e = np.sum(mask)
+    out = {key:sample[key][offset:offset+n_e] for key in sample}
+    labels[offset:offset+n_e] = make_sample(data_file, idx, input_data, n_tracks, n_classes, verbose,
+                                            mask=mask, out=out)[1]
+    return time.time() - start_time
+
+
+def cut_mask(data_file, idx, n_classes, cuts):
+    #returns the truth labelling and cuts masks by decompressing only the columns they use
+    if not isinstance(cuts, Cuts): cuts = Cuts(cuts)
+    columns = set(label_keys) | set([sample_aliases.get(key, key) for key in cuts.columns])
+    data   = h5_pool.open(data_file)
+    sample = with_aliases({key:read_column(data[key], idx) for key in columns if key in data})
+    truth_cut = make_labels(sample, n_classes) != -1
+    return truth_cut, cuts(sample, truth_cut)
+
+
+class Cuts:
+    #cut strings are parsed once into expression trees of numpy functions and evaluated
+    #together chunk by chunk; counts holds the number of rows passing each successive cut
+    def __init__(self, cuts=''):
+        if isinstance(cuts, Cuts): cuts = cuts.cuts
+        if isinstance(cuts, str) : cuts = [cuts]
+        self.cuts, self.trees = [], []
+        for cut in [cut for cut in cuts if cut.strip() != '']:
+            try:
+                self.trees += [cut_tree(ast.parse(cut.strip(), mode='eval').body)]; self.cuts += [cut]
+            except (SyntaxError, ValueError) as error: print('WARNING --> invalid cut:', cut, '('+str(error)+')')
+        self.keys    = [sorted(set(cut_keys(tree))) for tree in self.trees]
+        self.columns = sorted(set(sum(self.keys, [])))
+        self.counts  = np.zeros(len(self.trees), dtype=np.int64)
+    def __len__(self):
+        return len(self.trees)
+    def __call__(self, sample, mask, chunk_size=2**16):
+        #cuts using columns missing from the sample are skipped (see missing)
+        out = np.empty_like(mask, dtype=bool); self.counts[:] = 0
+        valid = [all(key in sample for key in keys) for keys in self.keys]
+        for idx in range(0, len(mask), chunk_size):
+            chunk  = {key:sample[key][idx:idx+chunk_size] for key in self.columns if key in sample}
+            passed = out[idx:idx+chunk_size]; np.copyto(passed, mask[idx:idx+chunk_size])
+            for n in range(len(self.trees)):
+                if valid[n]: np.logical_and(passed, cut_eval(self.trees[n], chunk), out=passed)
+                self.counts[n] += np.count_nonzero(passed)
+        return out
+    def missing(self, keys):
+        keys = set(keys) | set([key for key in sample_aliases if sample_aliases[key] in keys])
+        return [cut for cut, cut_keys in zip(self.cuts, self.keys) if not set(cut_keys) <= keys]
+    def cutflow(self, n_e, counts=None):
+        if counts is None: counts = self.counts
+        for cut, count in zip(self.cuts, counts):
+            print(format(count,'9d'), 'e conserved', '(' + format(100*count/max(1,n_e),'6.2f') + ' %) -->', cut)
+            n_e = count
+
+
+cut_operators = {'Add'   :np.add        , 'Sub'     :np.subtract     , 'Mult'   :np.multiply    , 'Div'  :np.true_divide,
+                 'Mod'   :np.mod        , 'FloorDiv':np.floor_divide  , 'Pow'    :np.power       , 'USub' :np.negative   ,
+                 'UAdd'  :np.positive   , 'BitAnd'  :np.bitwise_and   , 'BitOr'  :np.bitwise_or  , 'BitXor':np.bitwise_xor,
+                 'Invert':np.invert     , 'Not'     :np.logical_not   , 'And'    :np.logical_and , 'Or'   :np.logical_or ,
+                 'Eq'    :np.equal      , 'NotEq'   :np.not_equal     , 'Lt'     :np.less        , 'LtE'  :np.less_equal ,
+                 'Gt'    :np.greater    , 'GtE'     :np.greater_equal , 'In'     :np.isin        , 'abs'  :np.abs        ,
+                 'np.abs':np.abs        , 'np.sqrt' :np.sqrt          , 'np.log' :np.log         , 'np.exp':np.exp       ,
+                 'np.isin':np.isin      , 'np.minimum':np.minimum     , 'np.maximum':np.maximum  ,
+                 'np.logical_and':np.logical_and, 'np.logical_or':np.logical_or, 'np.logical_not':np.logical_not}
+def cut_tree(node):
+    #nodes are ('column', key), ('constant', value) or ('apply', operator, [arguments])
+    name = type(node).__name__
+    if name in ['Num', 'Str', 'NameConstant', 'Constant']:
+        return ('constant', getattr(node, 'value', getattr(node, 'n', getattr(node, 's', None))))
+    if name in ['List', 'Tuple']:
+        return ('constant', tuple(cut_tree(elt)[1] for elt in node.elts))
+    if name == 'Subscript' and getattr(node.value, 'id', '') == 'sample':
+        key = cut_tree(node.slice.value if type(node.slice).__name__ == 'Index' else node.slice)
+        if key[0] == 'constant' and isinstance(key[1], str): return ('column', key[1])
+    if name == 'BinOp'  : return cut_apply(node.op, [cut_tree(node.left), cut_tree(node.right)])
+    if name == 'UnaryOp': return cut_apply(node.op, [cut_tree(node.operand)])
+    if name == 'BoolOp' :
+        tree = cut_tree(node.values[0])
+        for value in node.values[1:]: tree = cut_apply(node.op, [tree, cut_tree(value)])
+        return tree
+    if name == 'Compare':
+        operands = [cut_tree(node.left)] + [cut_tree(value) for value in node.comparators]
+        tree = cut_apply(node.ops[0], operands[0:2])
+        for n in range(1, len(node.ops)): tree = ('apply', 'And', [tree, cut_apply(node.ops[n], operands[n:n+2])])
+        return tree
+    if name == 'Call' and len(node.keywords) == 0:
+        func = getattr(node.func, 'id', getattr(getattr(node.func, 'value', None), 'id', '')+'.'+getattr(node.func, 'attr', ''))
+        if func[0].islower(): return cut_apply(func, [cut_tree(arg) for arg in node.args])
+    raise ValueError('unsupported expression ' + name)
+def cut_apply(op, args):
+    op = op if isinstance(op, str) else type(op).__name__
+    if op not in cut_operators: raise ValueError('unsupported operator ' + op)
+    return ('apply', op, args)
+def cut_keys(tree):
+    if tree[0] == 'column': return [tree[1]]
+    if tree[0] == 'apply' : return sum([cut_keys(arg) for arg in tree[2]], [])
+    return []
+def cut_eval(tree, sample):
+    if tree[0] == 'column'  : return sample[tree[1]]
+    if tree[0] == 'constant': return tree[1]
+    return cut_operators[tree[1]](*[cut_eval(arg, sample) for arg in tree[2]])
+
+
+def shared_array(shape, dtype):
+    #zero-initialized array in anonymous shared memory, writable by forked processes
+    shape = (shape,) if np.isscalar(shape) else tuple(shape); dtype = np.dtype(dtype)
+    size  = int(np.prod(shape))
+    return np.frombuffer(mmap.mmap(-1, max(1, size*dtype.itemsize)), dtype=dtype, count=size).reshape(shape)
+
+
+sample_aliases = {'eta'      :'p_eta'                         , 'pt':'p_et_calo',
+                  'mu'       :'averageInteractionsPerCrossing',
+                  'SCTHits'  :'p_numberOfSCTHits'             ,
+                  'PixelHits':'p_numberOfPixelHits'           ,
+                  'BLHits'   :'p_numberOfInnermostPixelHits'  }
+label_keys     = ['p_iffTruth', 'p_TruthType', 'p_firstEgMotherPdgId', 'p_charge']
+def with_aliases(sample):
+    sample.update({key:sample[sample_aliases[key]] for key in sample_aliases if sample_aliases[key] in sample})
+    return sample
+
+
+def get_n_tasks(n_tasks=None):
+    #number of reading processes, defaulting to the Slurm CPU allocation or to the CPUs available to the job
+    if n_tasks is None and 'SLURM_CPUS_PER_TASK' in os.environ: n_tasks = int(os.environ['SLURM_CPUS_PER_TASK'])
+    if n_tasks is None: n_tasks = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else mp.cpu_count()
+    return max(1, n_tasks)
+
+
 class Batch_Generator(tf.keras.utils.Sequence):
     def __init__(self, data_files, indexes, input_data, n_tracks, n_classes,
-                 batch_size, cuts, scaler, t_scaler, weights=None, shuffle='OFF'):
-        self.data_files = data_files; self.indexes    = indexes
+                 batch_size, cuts, scaler, t_scaler, weights=None, shuffle='OFF', align='OFF', verbose='ON', dtype=None,
+                 buffer_size=8, pack='OFF'):
+        self.data_files = data_files; self.indexes    = indexes; self.dtype    = dtype
         self.input_data = input_data; self.n_tracks   = n_tracks
         self.n_classes  = n_classes ; self.batch_size = batch_size
-        self.cuts       = cuts      ; self.scaler     = scaler ;self.t_scaler = t_scaler
-        self.weights    = weights   ; self.shuffle    = shuffle
-        self.batch_dict = batch_idx(self.data_files, self.batch_size, self.indexes, self.weights, self.shuffle)
+        self.cuts       = Cuts(cuts); self.scaler     = scaler_engine(scaler) ;self.t_scaler = scaler_engine(t_scaler)
+        self.weights    = weights   ; self.shuffle    = shuffle; self.align    = align
+        self.epoch      = 0         ; self.buffer_size = buffer_size; self.stream_index = None
+        self.pack       = pack      ; self.loaded     = {}
+        keys = [('p_' if key == 'tracks' else '')+key for key in sum(list(self.input_data.values()), [])]
+        self.batch_dict = batch_idx(self.data_files, self.batch_size, self.indexes,
+                                    self.shuffle, self.align, verbose, keys)
+        #columns of prescaled files are read scaled and their scalers are no longer applied
+        self.prescaled  = prescaled_keys(self.data_files, self.scaler, self.t_scaler, self.input_data['scalars'])
+        if 'tracks' in self.prescaled: self.t_scaler = None
+        if set(self.input_data['scalars'])-{'tracks'} <= set(self.prescaled): self.scaler = None
+        if self.pack == 'ON':
+            #batches of exactly batch_size electrons passing the cuts, counted from the cut columns only
+            counts = [np.sum(cut_mask(self.data_files[self.batch_dict[key]['file']], self.batch_dict[key]['indices'],
+                                      self.n_classes, self.cuts)[1]) for key in self.batch_dict]
+            self.pass_counts = np.array(counts, dtype=np.int64); self.pack_order()
+            if verbose == 'ON':
+                print('Batch packing:', self.pass_edges[-1], 'e passing cuts -->', len(self), 'batches of', end=' ')
+                print(self.batch_size, 'e')
     def __len__(self):
+        if self.pack == 'ON': return int(np.ceil(self.pass_edges[-1]/self.batch_size))
         return len(self.batch_dict) #Number of batches per epoch
     def __getitem__(self, gen_index):
+        if self.shuffle == 'stream': return self.stream_batch(gen_index)
+        if self.pack    == 'ON'    : return self.packed_batch(gen_index)
+        return self.scale_batch(*self.load_batch(gen_index))
+    def pack_order(self):
+        #packed batches follow the chunk groups in a fixed order for the epoch, drawn anew each epoch when shuffled,
+        #and must be requested in order (model.fit with shuffle=False) for the groups to be decompressed once
+        self.order = np.arange(len(self.batch_dict))
+        if self.shuffle in ['ON', 'block'] and self.epoch > 0:
+            self.order = np.random.RandomState(self.epoch).permutation(len(self.batch_dict))
+        self.pass_edges = np.cumsum(np.append(0, self.pass_counts[self.order])); self.loaded = {}
+    def packed_batch(self, gen_index):
+        #passing electrons of consecutive chunk groups are concatenated and cut at multiples of batch_size;
+        #the last groups loaded are kept since they usually start the next batch
+        start, end = gen_index*self.batch_size, min((gen_index+1)*self.batch_size, self.pass_edges[-1])
+        groups = range(np.searchsorted(self.pass_edges, start, side='right')-1,
+                       np.searchsorted(self.pass_edges, end  , side='left'))
+        groups = [group for group in groups if self.pass_edges[group+1] > self.pass_edges[group]]
+        self.loaded = {group:self.loaded[group] if group in self.loaded else self.load_batch(self.order[group])
+                       for group in groups}
+        row_buffer = Row_Buffer()
+        for group in groups:
+            rows = slice(max(start-self.pass_edges[group], 0), end-self.pass_edges[group])
+            sample, labels, weights = self.loaded[group]
+            row_buffer.add({key:sample[key][rows] for key in sample}, labels[rows],
+                           None if weights is None else weights[rows])
+        return self.scale_batch(row_buffer.sample, row_buffer.labels, row_buffer.weights)
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.pack == 'ON': self.pack_order()
+    def stream_batch(self, gen_index):
+        #streaming shuffle: chunk groups are read in an order drawn anew each epoch and their rows are mixed in a
+        #buffer holding up to buffer_size groups; batches must be requested in order (model.fit with shuffle=False)
+        if gen_index == 0 or gen_index != self.stream_index:
+            random = np.random.RandomState(self.epoch)
+            self.order = random.permutation(len(self.batch_dict)); self.row_buffer = Row_Buffer(random)
+            self.n_read, self.n_rows = 0, 0
+        n_groups = len(self.batch_dict)
+        #rows still to come are estimated from the pass rate of the groups read so far
+        def batch_rows():
+            if self.pack == 'ON': return self.batch_size
+            n_rows = len(self.row_buffer) + self.n_rows/max(1,self.n_read)*(n_groups-self.n_read)
+            return int(np.ceil(n_rows/(len(self)-gen_index)))
+        while self.n_read < n_groups and (self.n_read < int(np.ceil((gen_index+1)*n_groups/len(self)))
+                                          + self.buffer_size-1 or len(self.row_buffer) < batch_rows()):
+            batch = self.load_batch(self.order[self.n_read]); self.row_buffer.add(*batch)
+            self.n_read += 1; self.n_rows += len(batch[1])
+        self.stream_index = gen_index + 1
+        return self.scale_batch(*self.row_buffer.take(batch_rows()))
+    def load_batch(self, gen_index):
         file_index = self.batch_dict[gen_index]['file']
         file_idx   = self.batch_dict[gen_index]['indices']
-        weights    = self.batch_dict[gen_index]['weights']
         data_file  = self.data_files[file_index]
-        sample, labels = make_sample(data_file, file_idx, self.input_data, self.n_tracks, self.n_classes)
-        sample, labels, weights = sample_cuts(sample, labels, weights, self.cuts)
+        mask = cut_mask(data_file, file_idx, self.n_classes, self.cuts)[1]
+        input_data = {key:[name for name in self.input_data[key] if name not in self.prescaled]
+                      for key in self.input_data}
+        sample, labels = make_sample(data_file, file_idx, input_data, self.n_tracks, self.n_classes, mask=mask)
+        for key in self.prescaled:
+            dataset = h5_pool.open(data_file)['scaled/'+key]; shape = dataset.shape[1:]
+            if key == 'tracks': shape = (min(self.n_tracks, shape[0]),) + shape[1:]
+            sample[key] = np.empty((np.sum(mask),)+shape, dtype=dataset.dtype)
+            read_rows(dataset, file_idx, sample[key], np.s_[:shape[0],] if key == 'tracks' else (), mask)
+        #weights looked up from the raw pt and eta columns (these may be read scaled from prescaled files)
+        if self.weights is not None:
+            data    = h5_pool.open(data_file)
+            weights = self.weights({'pt' :read_column(data['p_et_calo'], file_idx)[mask],
+                                    'eta':read_column(data['p_eta'    ], file_idx)[mask]}, labels)
+        else: weights = None
+        return sample, labels, weights
+    def scale_batch(self, sample, labels, weights=None):
         if len(labels) != 0:
             if self.scaler   != None: sample = apply_scaler(sample, self.input_data['scalars'], self.scaler)
             if self.t_scaler != None: sample = apply_t_scaler(sample, self.t_scaler)
+        if self.dtype is not None: sample = widen(sample, self.dtype)
         return sample, labels, weights
 
 
+class Row_Buffer:
+    #bounded pool of rows from which batches are drawn at random without replacement
+    def __init__(self, random=np.random):
+        self.random = random; self.sample = None; self.labels = None; self.weights = None
+    def __len__(self):
+        return 0 if self.labels is None else len(self.labels)
+    def add(self, sample, labels, weights=None):
+        if self.labels is None: self.sample, self.labels, self.weights = dict(sample), labels, weights; return
+        self.sample = {key:np.concatenate([self.sample[key], sample[key]]) for key in self.sample}
+        self.labels = np.concatenate([self.labels, labels])
+        if weights is not None: self.weights = np.concatenate([self.weights, weights])
+    def take(self, n_rows):
+        rows = np.zeros(len(self), dtype=bool)
+        rows[self.random.choice(len(self), min(n_rows, len(self)), replace=False)] = True
+        batch = ({key:self.sample[key][rows] for key in self.sample}, self.labels[rows],
+                 None if self.weights is None else self.weights[rows])
+        self.sample  = {key:self.sample[key][~rows] for key in self.sample}; self.labels = self.labels[~rows]
+        if self.weights is not None: self.weights = self.weights[~rows]
+        return batch
+
+
+def batch_dataset(generator, n_parallel=None):
+    #tf.data pipeline over the batches of a Batch_Generator: the batches of each HDF5 file are read in order by a
+    #parallel interleave across files, scaled by a parallel map and prefetched; weights stay with their batch
+    #with pack='ON', the batches are re-cut to exactly batch_size electrons; with shuffle 'ON' or 'block', the order
+    #of the files and of their batches is drawn anew each epoch and shuffle='stream' reads the stream_batch buffer
+    autotune = tf.data.experimental.AUTOTUNE if n_parallel is None else n_parallel
+    scalars, images, _ = generator.input_data.values()
+    raw_batch = generator.load_batch(0)
+    keys      = [key for key in raw_batch[0] if key in scalars+images]
+    n_arrays  = len(keys) + (1 if raw_batch[2] is None else 2)
+    def flatten(sample, labels, weights=None):
+        return [sample[key] for key in keys] + [labels] + ([] if weights is None else [weights])
+    raw_dtypes = [tf.as_dtype(array.dtype) for array in flatten(*raw_batch)][:n_arrays]
+    batch      = generator.scale_batch(*raw_batch)
+    def load(gen_index):
+        return flatten(*generator.load_batch(int(gen_index)))
+    def scale(*arrays):
+        sample = dict(zip(keys, arrays))
+        return flatten(*generator.scale_batch(sample, *arrays[len(keys):]))
+    def structure(*arrays):
+        for array, value in zip(arrays, flatten(*batch)): array.set_shape((None,)+value.shape[1:])
+        return (dict(zip(keys, arrays)),) + arrays[len(keys):]
+    dtypes     = [tf.as_dtype(array.dtype) for array in flatten(*batch    )][:n_arrays]
+    if generator.shuffle == 'stream':
+        #batches must be requested in order, each pass over the dataset being one epoch
+        def stream():
+            for gen_index in range(len(generator)): yield tuple(flatten(*generator.stream_batch(gen_index)))
+            generator.on_epoch_end()
+        dataset = tf.data.Dataset.from_generator(stream, tuple(dtypes)).map(structure)
+        return dataset.prefetch(autotune)
+    shuffle    = generator.shuffle in ['ON', 'block']
+    files      = sorted(set([generator.batch_dict[key]['file'] for key in generator.batch_dict]))
+    shards     = [[key for key in generator.batch_dict if generator.batch_dict[key]['file'] == n] for n in files]
+    table      = np.full((len(shards), max(map(len, shards))), -1, dtype=np.int64)
+    for n in range(len(shards)): table[n,:len(shards[n])] = shards[n]
+    def read_shard(shard):
+        shard = tf.data.Dataset.from_tensor_slices(shard).filter(lambda gen_index: gen_index >= 0)
+        if shuffle: shard = shard.shuffle(table.shape[1], reshuffle_each_iteration=True)
+        return shard.map(lambda gen_index: tuple(tf.numpy_function(load, [gen_index], raw_dtypes)))
+    dataset = tf.data.Dataset.from_tensor_slices(table)
+    if shuffle: dataset = dataset.shuffle(len(table), reshuffle_each_iteration=True)
+    dataset = dataset.interleave(read_shard, cycle_length=len(shards), num_parallel_calls=autotune)
+    dataset = dataset.map(lambda *arrays: tuple(tf.numpy_function(scale, arrays, dtypes)), num_parallel_calls=autotune)
+    dataset = dataset.map(structure)
+    if generator.pack == 'ON': dataset = dataset.unbatch().batch(generator.batch_size)
+    return dataset.prefetch(autotune)
+
+
+class Sample_Sequence(tf.keras.utils.Sequence):
+    #in-memory sample fed by mini-batches, with float16 host arrays widened to dtype batch by batch
+    def __init__(self, sample, labels, batch_size, weights=None, shuffle='OFF', dtype=np.float32):
+        self.sample     = sample    ; self.labels  = labels ; self.weights = weights
+        self.batch_size = batch_size; self.shuffle = shuffle; self.dtype   = dtype
+        self.n_e        = len(next(iter(sample.values())))  ; self.on_epoch_end()
+    def __len__(self):
+        return int(np.ceil(self.n_e/self.batch_size))
+    def __getitem__(self, gen_index):
+        idx = slice(gen_index*self.batch_size, (gen_index+1)*self.batch_size)
+        if self.shuffle == 'ON': idx = np.sort(self.indices[idx])
+        sample = widen({key:self.sample[key][idx] for key in self.sample}, self.dtype)
+        if self.labels is None: return sample
+        return sample, self.labels[idx], None if self.weights is None else self.weights[idx]
+    def on_epoch_end(self):
+        if self.shuffle == 'ON': self.indices = np.random.permutation(self.n_e)
+
+
 def sample_cuts(sample, labels, weights=None, cuts='', verbose='OFF'):
     if np.sum(labels==-1) != 0:
         length = len(labels)
@@ -352,13 +1154,10 @@ def sample_cuts(sample, labels, weights=None, cuts='', verbose='OFF'):
         if verbose == 'ON':
             print('Applying IFFtruth cuts -->', format(len(labels),'9d'), 'e conserved', end=' ')
             print('(' + format(100*len(labels)/length, '.2f') + ' %)')
-    cut_list = [np.full_like(labels, True, dtype=bool)]
-    for cut in cuts:
-        try:
-            cut_list.append(eval(cut))
-        except:
-            if verbose == 'ON' and cut != '': print('WARNING --> invalid cut:' , cut)
-    eval_cuts = np.logical_and.reduce(cut_list)
+    cuts = Cuts(cuts)
+    if verbose == 'ON':
+        for cut in cuts.missing(sample): print('WARNING --> cut skipped (missing column):', cut)
+    eval_cuts = cuts(sample, np.full_like(labels, True, dtype=bool))
     length = len(labels)
     labels = labels[eval_cuts]
     if np.all(weights) != None: weights = weights[eval_cuts]
@@ -421,18 +1220,203 @@ def fit_scaler(sample, scalars, scaler_out):
     scalars_array = np.hstack([np.expand_dims(np.float32(sample[key]), axis=1) for key in scalars])
     scaler = preprocessing.QuantileTransformer(output_distribution='normal', n_quantiles=10000, random_state=0)
     scaler.fit(scalars_array) #scaler.fit_transform(scalars_array)
+    scaler.scalars = scalars
     print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
     print('Saving  quantile transform to', scaler_out, '\n')
-    pickle.dump(scaler, open(scaler_out, 'wb'))
+    save_scaler(scaler, scaler_out)
     return scaler
 
 
-def apply_scaler(sample, scalars, scaler, verbose='OFF'):
+def sketch_scaler(data_files, idx, scalars, cuts, n_classes, scaler_out, n_tasks=None, batch_size=2**16):
+    #quantile transform fitted from the scalars of the generator batches without a full in-memory sample;
+    #each task sketches a share of the chunk groups and the partial sketches are merged
+    print('Sketching quantile transform from scalars', end=' --> ', flush=True); start_time = time.time()
+    scalars    = [key for key in scalars if key != 'tracks']
+    batch_dict = batch_idx(data_files, batch_size, idx, align='ON')
+    n_tasks    = min(get_n_tasks(n_tasks), len(batch_dict))
+    func_args  = [([(data_files[batch_dict[key]['file']], batch_dict[key]['indices'])
+                    for key in list(batch_dict)[task::n_tasks]], scalars, cuts, n_classes) for task in range(n_tasks)]
+    if n_tasks > 1:
+        with mp.Pool(n_tasks) as pool: sketches = pool.map(sketch_batches, func_args)
+    else: sketches = [sketch_batches(arg) for arg in func_args]
+    sketch = sketches[0]
+    for other in sketches[1:]: sketch.merge(other)
+    scaler = sketch.transformer(); scaler.scalars = scalars
+    print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+    print('Saving  quantile transform to', scaler_out, '\n')
+    save_scaler(scaler, scaler_out)
+    return scaler
+def sketch_batches(func_args):
+    batches, scalars, cuts, n_classes = func_args
+    sketch = Quantile_Sketch(len(scalars)); cuts = Cuts(cuts)
+    for data_file, idx in batches:
+        mask   = cut_mask(data_file, idx, n_classes, cuts)[1]
+        sample = make_sample(data_file, idx, {'scalars':scalars, 'images':[], 'others':label_keys}, 0, n_classes,
+                             mask=mask, lazy=True)[0]
+        sketch.update(np.hstack([np.expand_dims(np.float32(sample[key]), axis=1) for key in scalars]))
+    return sketch
+
+
+class Quantile_Sketch:
+    #mergeable summary of each column: weighted points compacted to size points of equal weight (nearest rank),
+    #with the exact minima and maxima; exported to the fitted attributes of a QuantileTransformer
+    def __init__(self, n_columns, size=2**17):
+        self.size    = size; self.n_columns = n_columns; self.count = 0
+        self.values  = [np.empty(0, dtype=np.float64) for n in range(n_columns)]
+        self.weights = [np.empty(0, dtype=np.float64) for n in range(n_columns)]
+        self.min     = np.full(n_columns, np.inf); self.max = np.full(n_columns, -np.inf)
+    def update(self, block):
+        self.count += len(block)
+        for n in range(self.n_columns): self.add(n, block[:,n], np.ones(len(block)))
+    def merge(self, other):
+        self.count += other.count
+        for n in range(self.n_columns): self.add(n, other.values[n], other.weights[n])
+        self.min = np.minimum(self.min, other.min); self.max = np.maximum(self.max, other.max)
+    def add(self, n, values, weights):
+        #nan are ignored as in QuantileTransformer.fit
+        finite = ~np.isnan(values); values, weights = values[finite], weights[finite]
+        if len(values) == 0: return
+        self.min[n] = min(self.min[n], np.min(values)); self.max[n] = max(self.max[n], np.max(values))
+        self.values [n] = np.concatenate([self.values [n], values ])
+        self.weights[n] = np.concatenate([self.weights[n], weights])
+        if len(self.values[n]) > 2*self.size: self.compact(n)
+    def compact(self, n):
+        values, weights = self.sorted(n); cum_weights = np.cumsum(weights)
+        grid = (np.arange(self.size)+0.5)*cum_weights[-1]/self.size
+        self.values [n] = values[np.minimum(np.searchsorted(cum_weights, grid), len(values)-1)]
+        self.weights[n] = np.full(self.size, cum_weights[-1]/self.size)
+    def sorted(self, n):
+        order = np.argsort(self.values[n], kind='stable')
+        return self.values[n][order], self.weights[n][order]
+    def quantiles(self, references):
+        quantiles = np.zeros((len(references), self.n_columns))
+        for n in range(self.n_columns):
+            if len(self.values[n]) == 0: continue
+            values, weights = self.sorted(n); cum_weights = np.cumsum(weights)
+            #linear interpolation between ranks as in np.percentile for unit weights
+            positions = (cum_weights - weights)/max(cum_weights[-1] - weights[-1], 1e-12)
+            quantiles[:,n] = np.interp(references, positions, values)
+            quantiles[0,n], quantiles[-1,n] = self.min[n], self.max[n]
+        return np.maximum.accumulate(quantiles, axis=0)
+    def transformer(self, n_quantiles=10000, output_distribution='normal'):
+        n_quantiles = max(1, min(n_quantiles, self.count))
+        scaler = preprocessing.QuantileTransformer(output_distribution=output_distribution,
+                                                   n_quantiles=n_quantiles, random_state=0)
+        scaler.n_quantiles_   = n_quantiles; scaler.references_ = np.linspace(0, 1, n_quantiles, endpoint=True)
+        scaler.quantiles_     = self.quantiles(scaler.references_)
+        scaler.n_features_in_ = self.n_columns
+        return scaler
+
+
+class Quantile_Engine:
+    #QuantileTransformer.transform from tables of the fitted quantiles: repeated quantiles are merged into one knot
+    #mapped to the mean of their references (as the forward/backward interpolation average of sklearn) and values
+    #between knots are interpolated after a searchsorted; columns are transformed in parallel threads of a pool kept
+    #by the engine (serially for small batches) and agree with sklearn on the float32 columns, except for values
+    #within float rounding of a repeated quantile
+    def __init__(self, quantiles, references, output_distribution='normal', scalars=None):
+        self.quantiles, self.references, self.output_distribution = quantiles, references, output_distribution
+        self.scalars = scalars; self.pool = None
+        self.normal = output_distribution == 'normal'; self.tables = []; self.n_columns = quantiles.shape[1]
+        for n in range(self.n_columns):
+            knots, first = np.unique(quantiles[:,n], return_index=True)
+            last  = np.append(first[1:], len(references)) - 1
+            lower, upper = references[first], references[last]
+            slope = (lower[1:] - upper[:-1])/np.diff(knots) if len(knots) > 1 else np.zeros(0)
+            self.tables += [(knots, (lower+upper)/2, upper, slope)]
+        self.clip = special.ndtri([1e-7 - np.spacing(1), 1 - (1e-7 - np.spacing(1))])
+    def transform_column(self, n, column, out, block_size=2**18):
+        knots, middle, upper, slope = self.tables[n]; slope = np.append(slope, 0)
+        for idx in range(0, len(column), block_size):
+            #inputs are widened to float32 (float16 columns of the presampled files included) and the bounds and
+            #references rounded to float32 as in sklearn on the widened columns
+            raw    = np.float32(column[idx:idx+block_size]); block = np.float64(raw)
+            index  = np.clip(np.searchsorted(knots, block, side='right') - 1, 0, len(knots)-1)
+            values = np.where(block == knots[index], middle[index], upper[index] + (block-knots[index])*slope[index])
+            if self.normal:
+                values = np.where(raw - 1e-7 < knots[0], 0, np.where(raw + 1e-7 > knots[-1], 1, values))
+                values = np.clip(special.ndtri(np.float32(values)), *self.clip)
+            else: values = np.where(block <= knots[0], 0, np.where(block >= knots[-1], 1, values))
+            out[idx:idx+block_size] = np.where(np.isnan(block), np.nan, values)
+    def transform(self, columns, outs, n_threads=None, min_rows=2**16):
+        n_threads = min(len(columns), get_n_tasks(n_threads))
+        if n_threads == 1 or sum([len(column) for column in columns]) < min_rows:
+            for n in range(len(columns)): self.transform_column(n, columns[n], outs[n])
+            return
+        #the pool is created on first use and again after a fork or for another number of threads
+        if self.pool is None or self.pool[0] != (os.getpid(), n_threads):
+            if self.pool is not None and self.pool[0][0] == os.getpid(): self.pool[1].terminate()
+            self.pool = ((os.getpid(), n_threads), mp.pool.ThreadPool(n_threads))
+            atexit.register(self.pool[1].terminate)
+        self.pool[1].starmap(self.transform_column, zip(range(len(columns)), columns, outs))
+    def __getstate__(self):
+        #engines are sent to worker processes without their threads
+        return dict(self.__dict__, pool=None)
+class Robust_Engine:
+    #RobustScaler.transform from its centres and scales
+    def __init__(self, center, scale):
+        self.center, self.scale = center, scale
+    def transform(self, X):
+        return np.asarray((X - self.center) / self.scale, dtype=X.dtype if X.dtype.kind == 'f' else np.float64)
+def scaler_engine(scaler):
+    #sklearn scalers are replaced by the engines applied without sklearn
+    if isinstance(scaler, preprocessing.QuantileTransformer):
+        return Quantile_Engine(scaler.quantiles_, scaler.references_, scaler.output_distribution,
+                               getattr(scaler, 'scalars', None))
+    if isinstance(scaler, preprocessing.RobustScaler):
+        n_columns = scaler.n_features_in_
+        return Robust_Engine(np.zeros(n_columns) if scaler.center_ is None else scaler.center_,
+                             np.ones (n_columns) if scaler.scale_  is None else scaler.scale_ )
+    return scaler
+def scaler_id(scaler):
+    #identity of a fitted scaler from its tables, recorded in prescaled files
+    engine = scaler_engine(scaler)
+    arrays = [engine.quantiles, engine.references] if isinstance(engine, Quantile_Engine) else [engine.center,
+                                                                                                 engine.scale]
+    return hashlib.sha1(b''.join([np.float64(array).tobytes() for array in arrays])).hexdigest()[:16]
+def save_scaler(scaler, scaler_out):
+    #.npz files hold the quantile tables or the robust centres and scales, other files the pickled scaler
+    if scaler_out.endswith('.npz'):
+        engine = scaler_engine(scaler)
+        if isinstance(engine, Quantile_Engine):
+            np.savez(scaler_out, type='quantile', quantiles=engine.quantiles, references=engine.references,
+                     output_distribution=engine.output_distribution, scalars=engine.scalars or [])
+        else: np.savez(scaler_out, type='robust', center=engine.center, scale=engine.scale)
+    else: pickle.dump(scaler, open(scaler_out, 'wb'))
+def load_scaler(scaler_in):
+    if not scaler_in.endswith('.npz'): return pickle.load(open(scaler_in, 'rb'))
+    with np.load(scaler_in) as data:
+        if str(data['type']) == 'quantile':
+            scalars = [str(key) for key in data['scalars']] if 'scalars' in data else []
+            return Quantile_Engine(data['quantiles'], data['references'], str(data['output_distribution']),
+                                   scalars if scalars != [] else None)
+        return Robust_Engine(data['center'], data['scale'])
+
+
+def apply_scaler(sample, scalars, scaler, verbose='OFF', dtype=np.float32, block_size=2**20):
+    #scalars are transformed by blocks of rows directly into arrays of the host dtype; quantile transforms use
+    #Quantile_Engine and write in place over arrays of that dtype not shared with another key (aliases)
     if verbose == 'ON':
         print('Applying quantile transform to scalars', end=' --> ', flush=True); start_time = time.time()
     scalars = [key for key in scalars if key != 'tracks']
-    scalars_array = scaler.transform(np.hstack([np.expand_dims(np.float32(sample[key]), axis=1) for key in scalars]))
-    for n in np.arange(len(scalars)): sample[scalars[n]] = scalars_array[:,n]
+    scaler  = scaler_engine(scaler)
+    if isinstance(scaler, Quantile_Engine):
+        arrays = {}
+        for key in scalars:
+            array    = sample[key]
+            shared   = type(sample) != dict or any(sample[other] is array for other in sample if other != key)
+            in_place = isinstance(array, np.ndarray) and array.dtype == dtype and array.flags.writeable
+            arrays[key] = array if in_place and not shared else np.empty(len(array), dtype=dtype)
+        scaler.transform([sample[key] for key in scalars], [arrays[key] for key in scalars])
+        sample.update(arrays)
+        if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)\n')
+        return sample
+    n_e     = len(sample[scalars[0]]); arrays = {key:np.empty(n_e, dtype=dtype) for key in scalars}
+    for idx in range(0, max(1,n_e), block_size):
+        block = np.hstack([np.expand_dims(np.float32(sample[key][idx:idx+block_size]), axis=1) for key in scalars])
+        block = scaler.transform(block)
+        for n in np.arange(len(scalars)): arrays[scalars[n]][idx:idx+block_size] = block[:,n]
+    sample.update(arrays)
     if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)\n')
     return sample
 
@@ -445,30 +1429,42 @@ def fit_t_scaler(sample, scaler_out):
     scaler.fit(np.reshape(tracks, (shape[0]*shape[1],-1)))
     print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
     print('Saving   tracks scaler file in', scaler_out, '\n')
-    pickle.dump(scaler, open(scaler_out, 'wb'))
+    save_scaler(scaler, scaler_out)
     return scaler
 
 
-def apply_t_scaler(sample, scaler, verbose='OFF'):
+def apply_t_scaler(sample, scaler, verbose='OFF', dtype=None, block_size=2**22):
     if verbose == 'ON':
         print('Applying quantile transform to tracks', end=' --> ', flush=True); start_time = time.time()
     tracks = sample['tracks']; shape = tracks.shape
-    tracks = np.reshape(tracks, (shape[0]*shape[1],-1))
-    tracks = scaler.transform(tracks)
-    sample['tracks'] = np.reshape(tracks, shape)
+    tracks = np.reshape(tracks, (shape[0]*shape[1],-1)); scaled = None
+    for idx in range(0, max(1,len(tracks)), block_size):
+        block = scaler.transform(tracks[idx:idx+block_size])
+        if scaled is None: scaled = np.empty(tracks.shape, dtype=block.dtype if dtype is None else dtype)
+        scaled[idx:idx+block_size] = block
+    sample['tracks'] = np.reshape(scaled, shape)
     if verbose == 'ON': print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)\n')
     return sample
 
 
-def sample_composition(sample, tag='valid'):
-    MC_type, IFF_type = sample['p_TruthType']    , sample['p_iffTruth']
-    MC_list, IFF_list = np.arange(max(MC_type)+1), np.arange(max(IFF_type)+1)
-    ratios = np.array([ [np.sum(MC_type[IFF_type==IFF]==MC) for MC in MC_list] for IFF in IFF_list ])
-    IFF_sum, MC_sum = 100*np.sum(ratios, axis=0)/len(MC_type), 100*np.sum(ratios, axis=1)/len(MC_type)
-    ratios = np.round(1e4*ratios/len(MC_type))/100
+def compo_counts(sample):
+    #electrons of each (IFF, MC) truth type pair
+    MC_type, IFF_type = np.int64(sample['p_TruthType']), np.int64(sample['p_iffTruth'])
+    n_MC, n_IFF = max(MC_type)+1, max(IFF_type)+1
+    return np.bincount(IFF_type*n_MC + MC_type, minlength=n_IFF*n_MC).reshape(n_IFF, n_MC)
+def add_compo(compos):
+    shape = np.max([compo.shape for compo in compos], axis=0); total = np.zeros(shape, dtype=np.int64)
+    for compo in compos: total[:compo.shape[0],:compo.shape[1]] += compo
+    return total
+def sample_composition(sample, tag='valid', counts=None):
+    #counts: compo_counts of the sample (e.g. accumulated over the generator batches)
+    ratios   = compo_counts(sample) if counts is None else counts; n_e = np.sum(ratios)
+    MC_list, IFF_list = np.arange(ratios.shape[1]), np.arange(ratios.shape[0])
+    IFF_sum, MC_sum = 100*np.sum(ratios, axis=0)/n_e, 100*np.sum(ratios, axis=1)/n_e
+    ratios = np.round(1e4*ratios/n_e)/100
     MC_empty, IFF_empty = np.where(np.sum(ratios, axis=0)==0)[0], np.where(np.sum(ratios, axis=1)==0)[0]
     MC_list,  IFF_list  = sorted(list(set(MC_list)-set(MC_empty))), sorted(list(set(IFF_list)-set(IFF_empty)))
-    print('IFFTRUTH AND TRUTHTYPE '+tag.upper()+' SAMPLE COMPOSITION (', '\b'+str(len(MC_type)), 'e)')
+    print('IFFTRUTH AND TRUTHTYPE '+tag.upper()+' SAMPLE COMPOSITION (', '\b'+str(n_e), 'e)')
     dash = (26+7*len(MC_list))*'-'
     print(dash, format('\n| IFF \ MC |','10s'), end='')
     for col in MC_list:
@@ -518,11 +1514,7 @@ def validation(output_dir, results_in, plotting, n_valid, n_etypes, valid_cuts):
         labels = np.where(labels==7, 6, labels)
 
     ratios = compo_matrix(labels, None, probs, n_etypes, verbose=False)
-    cut_list = [np.full_like(labels, True, dtype=bool)]
-    for cut in valid_cuts:
-        try   : cut_list.append(eval(cut))
-        except: pass
-    cuts = np.logical_and.reduce(cut_list)
+    cuts = Cuts(valid_cuts)(sample, np.full_like(labels, True, dtype=bool))
     sample, labels, probs = {key:sample[key][cuts] for key in sample}, labels[cuts], probs[cuts]
     if len(labels) == n_e: print('')
     else: print(' --> ('+str(len(labels))+' selected = '+format(100*len(labels)/n_e,'0.2f')+'%)')
@@ -557,12 +1549,16 @@ def confusion_matrix(labels, preds, n_etypes):
     return np.array([return_dict[m] for m in classes])
 
 
-def compo_matrix(valid_labels, train_labels=None, valid_probs=None, n_etypes=None, verbose=True):
+def compo_matrix(valid_labels, train_labels=None, valid_probs=None, n_etypes=None, verbose=True, train_counts=None):
+    #train_counts: electrons of each class of the training sample, in place of its labels
     if n_etypes is None:
         if train_labels is not None: n_etypes = len(np.unique(np.append(valid_labels, train_labels)))
         else                       : n_etypes = len(np.unique(valid_labels))
     classes = ['CLASS '+str(n) for n in range(n_etypes)]
     train_ratios = class_ratios(train_labels, n_etypes) if train_labels is not None else n_etypes*['n/a']
+    if train_counts is not None:
+        train_ratios = [100*train_counts[n]/np.sum(train_counts) if n < len(train_counts) else 0.
+                        for n in range(n_etypes)]
     valid_ratios = class_ratios(valid_labels, n_etypes)
     #valid_ratios = [17.42, 0.523, 0.559, 1.532, 79.966]
     if valid_probs is None:
@@ -639,18 +1635,32 @@ def make_discriminant(sample, labels, probs, n_etypes, sig_list, bkg, ratios=Non
     return sample, labels, probs
 
 
-def get_bins(var, var_bins=None, max_bins=100, min_bin_count=100, logspace=True, offset=0):
+def get_bins(var, var_bins=None, max_bins=100, min_bin_count=100, logspace=True, offset=0, labels=None):
+    #one histogram of var on var_bins, then underpopulated bins are merged from the counts only;
+    #with labels, the bins are refined for each class in turn from per-class histograms
     if var_bins is None:
         min_var, max_var = np.min(np.float64(var)), np.max(np.float64(var))
         if logspace: var_bins = np.logspace(np.log10(min_var), np.log10(max_var), num=max_bins)
         else       : var_bins = np.linspace(         min_var ,          max_var , num=max_bins)
         var_bins[0], var_bins[-1] = min_var, max_var+offset
-    while True:
-        var_idx = np.clip(np.digitize(var, var_bins), 1, len(var_bins)-1) - 1
-        for idx in range(1,len(var_bins)-1)[::-1]:
-            if np.sum(var_idx==idx) < max(0, min_bin_count):
-                var_bins = np.delete(var_bins, idx) ; break
-        if idx == 1: return var_bins
+    var_bins = np.asarray(var_bins); n_bins = len(var_bins)-1
+    var_idx  = np.clip(np.searchsorted(var_bins, var, side='right'), 1, n_bins) - 1
+    if labels is None: return var_bins[merge_bins(np.bincount(var_idx, minlength=n_bins), min_bin_count)]
+    classes = np.unique(labels)
+    counts  = np.bincount(np.searchsorted(classes, labels)*n_bins + var_idx, minlength=len(classes)*n_bins)
+    counts  = np.reshape(counts, (len(classes), n_bins)); keep = merge_bins(np.sum(counts, axis=0), min_bin_count)
+    for class_counts in counts: keep = merge_bins(class_counts, min_bin_count, keep)
+    return var_bins[keep]
+def merge_bins(counts, min_bin_count, keep=None):
+    #indices of the edges kept (among edges keep of the counts) when bins with less than min_bin_count entries are
+    #merged into the bin below, from the last bin down to the second bin, as the former delete-one-bin loop did
+    keep   = np.arange(len(counts)+1) if keep is None else np.asarray(keep)
+    counts = np.add.reduceat(counts, keep[:-1]); kept = np.full(len(keep), True); total = 0
+    for idx in range(1, len(counts))[::-1]:
+        total += counts[idx]
+        if total < max(0, min_bin_count): kept[idx] = False
+        else: total = 0
+    return keep[kept]
 def cum_distribution(x):
     values, counts = np.unique(x, return_counts=True)
     if 0 not in values: values, counts = np.r_[0, values], np.r_[0, counts]
@@ -703,7 +1713,7 @@ def print_results(sample, labels, probs, n_etypes, plotting, output_dir, sig_lis
 
 
 def valid_results(sample, labels, probs, train_labels, n_etypes, output_dir, plotting,
-                  valid_ratios=None, sep_bkg=True, diff_plots=False, threshold=None):
+                  valid_ratios=None, sep_bkg=True, diff_plots=False, threshold=None, train_counts=None):
     global print_dict; print_dict = {n:'' for n in [1,2,3]}; print()
     if n_etypes == 5 and probs.shape[-1] == 6:
         probs  = np.hstack([probs[:,:4], (probs[:,4]+probs[:,5])[:,None]])
@@ -715,7 +1725,7 @@ def valid_results(sample, labels, probs, train_labels, n_etypes, output_dir, plo
     if n_etypes == 7 and probs.shape[-1] == 8:
         probs  = np.hstack([probs[:,:3], (probs[:,3]+probs[:,4])[:,None],
                             probs[:,5][:,None], probs[:,6][:,None], probs[:,7][:,None]])
-    ratios = compo_matrix(labels, train_labels, probs, n_etypes) ; print(print_dict[2])
+    ratios = compo_matrix(labels, train_labels, probs, n_etypes, train_counts=train_counts) ; print(print_dict[2])
     if valid_ratios is not None: ratios = valid_ratios
     """ Plotting efficiciency ratios mesh grid """
     #ratio_plots(sample, labels, probs, n_etypes, output_dir)
@@ -790,7 +1800,8 @@ def cross_valid(valid_sample, valid_labels, scalars, output_dir, n_folds, data_f
     for fold_number in np.arange(1, n_folds+1):
         print('FOLD '+str(fold_number)+'/'+str(n_folds), 'EVALUATION')
         weight_file = output_dir+'/model_' +str(fold_number)+'.h5'
-        scaler_file = output_dir+'/scaler_'+str(fold_number)+'.pkl'
+        scaler_file = output_dir+'/scaler_'+str(fold_number)+'.npz'
+        if not os.path.isfile(scaler_file): scaler_file = scaler_file.replace('.npz', '.pkl')
         print('Loading pre-trained weights from', weight_file)
         model.load_weights(weight_file); start_time = time.time()
         indices =               np.where(event_number%n_folds==fold_number-1)[0]
@@ -798,7 +1809,7 @@ def cross_valid(valid_sample, valid_labels, scalars, output_dir, n_folds, data_f
         sample  = {key:valid_sample[key][event_number%n_folds==fold_number-1] for key in valid_sample}
         if scalars != [] and os.path.isfile(scaler_file):
             print('Loading scalars scaler from', scaler_file)
-            scaler = pickle.load(open(scaler_file, 'rb'))
+            scaler = load_scaler(scaler_file)
             sample = apply_scaler(sample, scalars, scaler, verbose='ON')
         print('\033[FCLASSIFIER:', weight_file.split('/')[-1], 'class predictions for', len(labels), 'e')
         if generator == 'ON':
@@ -1074,12 +2085,12 @@ def feature_ranking(output_dir, results_out, scalars, images, groups):
 
 def presample(h5_file, output_dir, batch_size, sum_e, images, tracks, scalars, integers, file_key, n_tasks, index):
     idx = index*batch_size, (index+1)*batch_size
-    with h5py.File(h5_file, 'r') as data:
-        images  = list(set(images  ) & set(data[file_key]))
-        tracks  = list(set(tracks  ) & set(data[file_key]))
-        scalars = list(set(scalars ) & set(data[file_key]))
-        int_val = list(set(integers) & set(data[file_key]))
-        sample = {key:data[file_key][key][idx[0]:idx[1]] for key in images+tracks+scalars+int_val}
+    data    = h5_pool.open(h5_file)
+    images  = list(set(images  ) & set(data[file_key]))
+    tracks  = list(set(tracks  ) & set(data[file_key]))
+    scalars = list(set(scalars ) & set(data[file_key]))
+    int_val = list(set(integers) & set(data[file_key]))
+    sample = {key:data[file_key][key][idx[0]:idx[1]] for key in images+tracks+scalars+int_val}
     for key in ['em_barrel_Lr1', 'em_endcap_Lr1']:
         try:
             if sample[key].shape[1:] != (7,11):
@@ -1175,7 +2186,8 @@ def merge_presamples(output_dir, output_file):
     #h5_files = [h5_file for h5_file in os.listdir(output_dir) if 'myTag' in h5_file and '.h5' in h5_file]
     if len(h5_files) == 0: sys.exit()
     np.random.seed(0); np.random.shuffle(h5_files)
-    idx = np.cumsum([len(h5py.File(output_dir+'/'+h5_file, 'r')['eventNumber']) for h5_file in h5_files])
+    idx = np.cumsum([len(h5_pool.open(output_dir+'/'+h5_file)['eventNumber']) for h5_file in h5_files])
+    h5_pool.close()
     os.rename(output_dir+'/'+h5_files[0], output_dir+'/'+output_file)
     dataset = h5py.File(output_dir+'/'+output_file, 'a')
     GB_size = len(h5_files)*sum([np.float16(dataset[key]).nbytes for key in dataset])/(1024)**2/1e3
@@ -1183,16 +2195,79 @@ def merge_presamples(output_dir, output_file):
     print('output/'+output_file, end=' .' if len(h5_files)>1 else '', flush=True); start_time = time.time()
     for key in dataset: dataset[key].resize((idx[-1],) + dataset[key].shape[1:])
     for h5_file in h5_files[1:]:
-        data  = h5py.File(output_dir+'/'+h5_file, 'r')
+        data  = h5_pool.open(output_dir+'/'+h5_file)
         index = h5_files.index(h5_file)
         for key in dataset:
             if dataset[key].dtype != 'object':
                 dataset[key][idx[index-1]:idx[index]] = data[key]
-        data.close(); os.remove(output_dir+'/'+h5_file)
+        h5_pool.close(output_dir+'/'+h5_file); os.remove(output_dir+'/'+h5_file)
         print('.', end='', flush=True)
+    dataset.close()
     print(' (', '\b'+format(time.time() - start_time,'.1f'), '\b'+' s) -->', idx[-1], 'ELECTRONS COLLECTED\n')
 
 
+def prescale_files(data_files, output_dir, scaler, t_scaler=None, scalars=None, n_tasks=None):
+    #training-ready data files holding the scaled scalars (and tracks) as float16 datasets of the 'scaled' group, on
+    #the chunk rows of the data files, whose other datasets are external links (relative paths) to the data files
+    #rather than copies, so the source files must stay in place; the identity of the scalers is
+    #recorded in the file attributes (prescaled_keys); float16 casts are done by numpy as the HDF5 conversion does
+    #not carry mantissa rounding into the exponent
+    engine  = scaler_engine(scaler)
+    scalars = [key for key in (engine.scalars if scalars is None else scalars) if key != 'tracks']
+    if len(scalars) != engine.n_columns:
+        raise ValueError('prescale_files: '+str(len(scalars))+' scalars for '+str(engine.n_columns)+' columns')
+    for path in list(itertools.accumulate([folder+'/' for folder in output_dir.split('/')])):
+        try: os.mkdir(path)
+        except FileExistsError: pass
+    print('Prescaling', len(data_files), 'files to', output_dir, end=' --> ', flush=True); start_time = time.time()
+    func_args = [(data_file, output_dir, engine, scaler_engine(t_scaler), scalars) for data_file in data_files]
+    n_tasks   = min(get_n_tasks(n_tasks), len(data_files))
+    if n_tasks > 1:
+        with mp.Pool(n_tasks) as pool: pool.map(prescale_file, func_args)
+    else: [prescale_file(arg) for arg in func_args]
+    print('(', '\b'+format(time.time() - start_time, '2.1f'), '\b'+' s)')
+def prescale_file(func_args, block_chunks=64, prefix='p_'):
+    data_file, output_dir, engine, t_engine, scalars = func_args
+    manifest = get_manifest([data_file], verbose='OFF')[data_file]
+    n_e, step = manifest['n_e'], chunk_rows(manifest)*block_chunks
+    data_in  = h5_pool.open(data_file); output_file = output_dir+'/'+data_file.split('/')[-1]
+    data_out = h5py.File(output_file+'.tmp', 'w')
+    source   = os.path.relpath(os.path.abspath(data_file), os.path.abspath(output_dir))
+    for key in [key for key in data_in if key != 'scaled']: data_out[key] = h5py.ExternalLink(source, key)
+    data_out.attrs.update(data_in.attrs)
+    data_out.attrs['scaler_id'] = scaler_id(engine); data_out.attrs['scalars'] = scalars
+    for n, key in enumerate(scalars):
+        dataset = data_out.create_dataset('scaled/'+key, (n_e,), dtype=np.float16, compression='lzf',
+                                          chunks=(min(max(1,n_e), chunk_rows(manifest)),))
+        for idx in range(0, n_e, step):
+            block = np.empty(min(step, n_e-idx), dtype=np.float32)
+            engine.transform_column(n, np.float32(data_in[key][idx:idx+step]), block); dataset[idx:idx+step] = np.float16(block)
+    if t_engine is not None and prefix+'tracks' in data_in:
+        shape   = data_in[prefix+'tracks'].shape; shape = (shape[1], min(len(t_engine.center), shape[2]))
+        dataset = data_out.create_dataset('scaled/tracks', (n_e,)+shape, dtype=np.float16, compression='lzf',
+                                          chunks=(min(max(1,n_e), chunk_rows(manifest)),)+shape)
+        for idx in range(0, n_e, step):
+            tracks = np.float32(data_in[prefix+'tracks'][idx:idx+step,:,:shape[1]])
+            np.abs(tracks[...,0:5], out=tracks[...,0:5]); dataset[idx:idx+step] = np.float16(t_engine.transform(tracks))
+        data_out.attrs['t_scaler_id'] = scaler_id(t_engine)
+    data_out.close(); os.replace(output_file+'.tmp', output_file)
+def prescaled_keys(data_files, scaler=None, t_scaler=None, scalars=[]):
+    #keys read from the 'scaled' group of prescaled files, refusing files prescaled by other scalers
+    attrs   = [get_manifest(data_files, verbose='OFF')[data_file]['attrs'] for data_file in data_files]
+    keys    = []
+    for scaler, id_key in [(scaler, 'scaler_id'), (t_scaler, 't_scaler_id')]:
+        ids = set([str(attr[id_key]) if id_key in attr else '' for attr in attrs])
+        if scaler is None or ids == {''}: continue
+        if ids != {scaler_id(scaler)}:
+            raise ValueError('data files prescaled with '+id_key+' '+str(sorted(ids))+' != '+scaler_id(scaler))
+        if id_key == 't_scaler_id': keys += ['tracks']; continue
+        stored = [[str(key) for key in attr['scalars']] for attr in attrs]
+        if any([stored_keys != [key for key in scalars if key != 'tracks'] for stored_keys in stored]):
+            raise ValueError('data files prescaled for scalars '+str(stored[0]))
+        keys += [key for key in scalars if key != 'tracks']
+    return keys
+
+
 def get_idx(size, start_value=0, n_sets=5):
     n_sets   = min(size, n_sets)
     idx_list = [start_value + n*(size//n_sets) for n in np.arange(n_sets)] + [start_value+size]
@@ -1218,8 +2293,8 @@ def mix_datafiles(input_path='', input_dir='', temp_dir='temp_dir', n_tasks=10,
         for job in processes: job.start()
         for job in processes: job.join()
 def file_mixing(h5_file, LF_files, index, output_dir):
-    features = utils.shuffle(list(h5py.File(h5_file,'r')), random_state=index)
-    MC_data  = h5py.File(h5_file,'r')
+    MC_data  = h5_pool.open(h5_file)
+    features = utils.shuffle(list(MC_data), random_state=index)
     if LF_files is not None:
         # Light flavor indices in MC file
         iffTruth  = MC_data['p_iffTruth' ][:]
@@ -1227,7 +2302,7 @@ def file_mixing(h5_file, LF_files, index, output_dir):
         MC_criteria = np.logical_or.reduce([TruthType==4, TruthType==16, TruthType==17])
         MC_criteria = np.logical_and(MC_criteria, iffTruth==10)
         MC_idx  = np.where(MC_criteria)[0]
-        LF_data = h5py.File(LF_files[index],'r')
+        LF_data = h5_pool.open(LF_files[index])
         source_size = len(list(LF_data.values())[0])
         target_size = np.sum(MC_criteria)
         # Light flavor indices from data file
@@ -1249,6 +2324,7 @@ def file_mixing(h5_file, LF_files, index, output_dir):
         print( 'Mixing file', h5_file.split('/')[-2]+'/'+h5_file.split('/')[-1], 'with feature', key )
         if LF_files is not None: data_out[key][:] =               data_in[:]
         else                   : data_out[key][:] = utils.shuffle(data_in[:], random_state=index)
+        data_out.close()
 
 
 def mix_presamples(input_path, output_dir, temp_dir='temp_dir', n_files=20, n_tasks=5):
@@ -1257,7 +2333,8 @@ def mix_presamples(input_path, output_dir, temp_dir='temp_dir', n_files=20, n_ta
     #sys.exit()
     output_dir = data_files[0].split(temp_dir)[0] + output_dir
     if not os.path.isdir(output_dir): os.mkdir(output_dir)
-    n_e      = [len(h5py.File(h5_file,'r')['eventNumber']) for h5_file in data_files]
+    manifest = get_manifest(data_files)
+    n_e      = [manifest[h5_file]['n_e'] for h5_file in data_files]
     idx_list = [get_idx(n, n_sets=n_files) for n in n_e]
     file_idx = list(utils.shuffle(np.arange(n_files), random_state=0))
     for idx in np.split(file_idx, np.arange(n_tasks, n_files, n_tasks)):
@@ -1267,9 +2344,10 @@ def mix_presamples(input_path, output_dir, temp_dir='temp_dir', n_files=20, n_ta
         for job in processes: job.start()
         for job in processes: job.join()
         print('run time:', format(time.time() - start_time, '2.1f'), '\b'+' s\n')
-    import shutil; shutil.rmtree( data_files[0].split(temp_dir)[0] + temp_dir )
+    h5_pool.close(); shutil.rmtree( data_files[0].split(temp_dir)[0] + temp_dir )
 def mix_samples(data_files, idx_list, file_idx, out_idx, output_dir):
-    features = list(set().union(*[h5py.File(h5_file,'r').keys() for h5_file in data_files]))
+    manifest = get_manifest(data_files, verbose='OFF')
+    features = list(set().union(*[manifest[h5_file]['keys'] for h5_file in data_files]))
     features = list(set(features)-{'p_passWVeto','p_trigMatches','p_passZVeto','p_trigMatches_pTbin','p_met'})
     features = utils.shuffle(features, random_state=out_idx)
     for key in features:
@@ -1277,20 +2355,20 @@ def mix_samples(data_files, idx_list, file_idx, out_idx, output_dir):
         for in_idx in utils.shuffle(np.arange(len(data_files)), random_state=out_idx):
             idx = idx_list[in_idx][out_idx]
             try:
-                sample_list += [h5py.File(data_files[in_idx],'r')[key][idx[0]:idx[1]]]
+                sample_list += [h5_pool.open(data_files[in_idx])[key][idx[0]:idx[1]]]
             except KeyError:
                 if 'fine' in key: sample_list += [np.zeros((idx[1]-idx[0],)+(56,11), dtype=np.int8)]
                 else            : sample_list += [np.zeros((idx[1]-idx[0],)+( 7,11), dtype=np.int8)]
         sample = np.concatenate(sample_list)
         file_name = 'e-ID_'+'{:=02}'.format(file_idx.index(out_idx))+'.h5'
         attribute = 'w' if key==features[0] else 'a'
-        data = h5py.File(output_dir+'/'+file_name, attribute, rdcc_nbytes=20*1024**3, rdcc_nslots=10000019)
+        data = h5py.File(output_dir+'/'+file_name, attribute, **rdcc_args([sample[:2000].nbytes]))
         shape    = (len(sample),) + sample.shape[1:]
         maxshape = (None,)+sample.shape[1:]
         dtype    = np.int32 if sample.dtype=='int32' else np.float16
         chunks   = (2000,)+sample.shape[1:]
         data.create_dataset(key, shape, maxshape=maxshape, dtype=dtype, compression='lzf', chunks=chunks)
-        data[key][:] = utils.shuffle(sample, random_state=0)
+        data[key][:] = utils.shuffle(sample, random_state=0); data.close()
         print( file_idx.index(out_idx), key)
 
 
@@ -1301,189 +2379,83 @@ def mix_samples(data_files, idx_list, file_idx, out_idx, output_dir):
 #################################################################################
 
 
-def find_bin(array,binning):
-
-    binarized_bin_indices=list()
-    for i in range(len(binning)-1):
-        binarized_bin_indices.append( ((binning[i]<array) & (array<=binning[i+1])).astype(float) )
-        #tmp_array = (binning[i]<array) & (array<binning[i+1])
-        #print(tmp_array)
-        pass
-
-    #print(np.shape(binarized_bin_indices[0]))
-
-    return binarized_bin_indices
-#def find_bin(element,binning):
-#
-#    binNum=-1 # underflow and overflow
-#    for i in range(len(binning)-1):
-#        if binning[i]<element and element<binning[i+1]: binNum=i
-#        pass
-#
-#    return binNum
-
 def get_bin_indices(p_var,boundaries):
-    bin_indices=list()
-    #print("hi=",boundaries[0],np.where( p_var<boundaries[0] )[0])
-    bin_indices.append (np.where( p_var<=boundaries[0] )[0])
-    for idx in range(len(boundaries)-1):
-        #print("lo, hi=",boundaries[idx],":",boundaries[idx+1])
-        bin_indices.append (np.where( (boundaries[idx]<p_var) & (p_var<=boundaries[idx+1]) )[0])
-        #bin_indices.append (np.where( (boundaries[idx]<=p_var) & (p_var<boundaries[idx+1]) & (isnan(p_var)) )[0])
-        pass
-    #print("lo=",boundaries[len(boundaries)-1],np.where( boundaries[len(boundaries)-1]<p_var )[0])
-    bin_indices.append (np.where( boundaries[len(boundaries)-1]<p_var )[0])
-    #print(len(bin_indices),len(boundaries))
-
-    tmp_idx=0
-    total=0
-    #total=len(bin_indices[0])
-    #print("hi=",boundaries[0],bin_indices[0],len(bin_indices[0]),total)
-
-    debug=False
-    for bin_idx in bin_indices:
-        total+=len(bin_idx)
-
-        if debug:
-            if tmp_idx==0:
-                print("hi=",boundaries[tmp_idx],bin_idx,len(bin_idx),total)
-            elif tmp_idx==len(bin_indices)-1:
-                print("lo=",boundaries[tmp_idx-1],bin_idx,len(bin_idx),total)
-            else:
-                print("lo,hi=[",boundaries[tmp_idx-1],",",boundaries[tmp_idx],"]",bin_idx,len(bin_idx),total)
-                pass
-            pass
-
-        tmp_idx+=1
-        pass
-    total+=len(bin_indices[-1])
-    #print("lo=",boundaries[-1],bin_indices[-1],len(bin_indices[-1]),total)
-
-    return bin_indices
+    #indices of p_var in (-inf,b0], (b0,b1], ..., (b_last,inf) from one stable sort of the bin numbers
+    #(nan values fall in no bin)
+    p_var   = np.asarray(p_var)
+    bin_num = np.searchsorted(boundaries, p_var, side='left')
+    bin_num = np.where(np.isnan(p_var), len(boundaries)+1, bin_num)
+    counts  = np.bincount(bin_num, minlength=len(boundaries)+2)
+    return np.split(np.argsort(bin_num, kind='stable'), np.cumsum(counts)[:-1])[:-1]
 
 def getMaxContents(binContents):
-
-    maxContents = np.full(len(binContents[0]),-1.)
-    for i_bin in range(len(binContents[0])):
-        for i in range(len(binContents)):
-            if binContents[i][i_bin] > maxContents[i_bin]: maxContents[i_bin] = binContents[i][i_bin]
-            pass
-        pass
-    #print("maxContens=",maxContents)
-
-    return maxContents
+    return np.max(np.float64(binContents), axis=0, initial=-1.)
 
 #def generate_weights(train_data,train_labels,nClass,weight_type='none',ref_var='pt',output_dir='outputs/'):
-def sample_weights(train_data,train_labels,nClass,weight_type,output_dir='outputs/',ref_var='pt'):
+def sample_weights(train_data,train_labels,nClass,weight_type,output_dir='outputs/',ref_var='pt',plotting='ON'):
     if weight_type=="none": return None
 
     print("-------------------------------")
     print("generate_weights: sample weight mode \"",weight_type,"\" designated. Generating weights.",)
     print("-------------------------------\n")
 
-    binning=[0,10,20,30,40,60,80,100,130,180,250,500]
+    binning        = np.array([0,10,20,30,40,60,80,100,130,180,250,500])
+    n_bins         = len(binning)-1
+    variable_array = train_data['p_et_calo'] #entire set
+    if   ref_var=='eta'  : variable_array = train_data['p_eta']
+    #elif ref_var=='pteta': variable_array = train_data['p_eta']
+    train_labels   = np.asarray(train_labels)
+    in_class       = (train_labels>=0) & (train_labels<nClass)
+
+    #KM: normalized histograms of each class from one digitize pass, with the [lo,hi[ bins of plt.hist
+    hist_bin = np.searchsorted(binning, variable_array, side='right') - 1
+    hist_bin = np.where(variable_array==binning[-1], n_bins-1, hist_bin)
+    in_hist  = in_class & (hist_bin>=0) & (hist_bin<n_bins)
+    binContents = np.bincount(train_labels[in_hist]*n_bins + hist_bin[in_hist], minlength=nClass*n_bins)
+    binContents = binContents.reshape(nClass, n_bins) / np.bincount(train_labels[in_class], minlength=nClass)[:,None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if weight_type=="flattening":
+            weights = np.mean(binContents, axis=1, keepdims=True)/binContents
+        elif weight_type=="match2max": #shaping to whichever that has max in the corresponding bin
+            weights = getMaxContents(binContents)/binContents
+        elif weight_type=="match2b": #shaping sig to match the bkg, using pt,or any other designated variable
+            weights = binContents[nClass-1]/binContents; weights[nClass-1] = 1
+        elif weight_type=="match2s": #shaping bkg to match the sig, using pt,or any other designated variable
+            weights = binContents[0]/binContents; weights[0] = 1
+    #KM: to replce inf with 0
+    weights = np.where(weights==np.inf, 0, weights)
+
+    #KM: weights of all events looked up from their class and ]lo,hi] bin, 0 outside the binning
+    weight_bin    = np.searchsorted(binning, variable_array, side='left') - 1
+    in_weights    = in_class & (weight_bin>=0) & (weight_bin<n_bins)
+    final_weights = np.zeros(len(variable_array), dtype=float)
+    final_weights[in_weights] = weights[train_labels[in_weights], weight_bin[in_weights]]
+
+    if plotting=='ON':
+        plot_sample_weights(variable_array, train_labels, nClass, binning, final_weights, output_dir, ref_var)
+    return final_weights
+
+def plot_sample_weights(variable_array,train_labels,nClass,binning,final_weights,output_dir='outputs/',ref_var='pt'):
     labels=['sig','bkg']
     colors=['blue','red']
-    binContents=[0,0]
     if nClass==6:
         #below 2b implemented
         labels=['sig','chf','conv','hf','eg','lf']
         colors=['blue','orange','green','red','purple','brown']
-        binContents=[0,0,0,0,0,0]
         pass
-
-    variable=list()                          #only for specific label
-    variable_array = train_data['p_et_calo'] #entire set
-    if   ref_var=='eta'  : variable_array = train_data['p_eta']
-    #elif ref_var=='pteta': variable_array = train_data['p_eta']
-
     for i_class in range(nClass):
-        variable.append( variable_array[ train_labels==i_class ] )
-        (binContents[i_class],bins,patches)=plt.hist(variable[i_class],bins=binning,weights=np.full(len(variable[i_class]),1/len(variable[i_class])),label=labels[i_class],histtype='step',facecolor=colors[i_class])
-        #(binContents[i_class],bins,patches)=plt.hist(variable[i_class],bins=binning,weights=np.full(len(variable[i_class]),1/len(train_labels)),label=labels[i_class],histtype='step',facecolor=colors[i_class])
+        variable = variable_array[ train_labels==i_class ]
+        plt.hist(variable,bins=binning,weights=np.full(len(variable),1/len(variable)),label=labels[i_class],histtype='step',facecolor=colors[i_class])
         pass
-
-        if nClass>2: plt.yscale("log")
-        plt.savefig(output_dir+'/'+ref_var+"_bfrReweighting.png")
+    if nClass>2: plt.yscale("log")
+    plt.savefig(output_dir+'/'+ref_var+"_bfrReweighting.png")
     plt.clf() #clear figure
 
-    weights=list() #KM: currently implemented for the 2-class case only
-    if weight_type=="flattening":
-        for i in range(nClass): weights.append(np.average(binContents[i])/binContents[i] )
-    elif weight_type=="match2max": #shaping to whichever that has max in the corresponding bin
-        #for i in range(nClass): print("bincontens[",i,"]=",binContents[i])
-        maxContents = getMaxContents(binContents)#print(maxContents)
-        for i in range(nClass): weights.append( maxContents/binContents[i] )
-    elif weight_type=="match2b": #shaping sig to match the bkg, using pt,or any other designated variable
-        for i in range(nClass-1): weights.append(binContents[nClass-1]/binContents[i])
-        weights.append(np.ones(len(binContents[5])))
-    elif weight_type=="match2s": #shaping bkg to match the sig, using pt,or any other designated variable
-        weights.append(np.ones(len(binContents[0])))
-        for i in range (1, nClass): weights.append(binContents[0]/binContents[i])
-        pass
-
-    #KM: to replce inf with 0
-    for i in range(nClass): weights[i]=np.where(weights[i]==np.inf,0,weights[i]) #np.where(array1==0, 1, array1)
-
-    debug=0
-    if debug:
-        tmp_i=0
-        for weight in weights:
-            print("weights[",labels[tmp_i],"]=",weight)
-            tmp_i+=1
-        #print(weights[0])
-        #print(weights[1])
-        pass
-
-    #KM: Generates weights for all events
-    #    This is not very efficient, to be improved
-
-    #final_weights*=weights[train_labels][1]
-
-    class_weight=list()
-    for i in range(nClass): class_weight.append( np.full(len(variable_array),0,dtype=float) )
-    final_weights= np.full(len(variable_array),0,dtype=float)
-    #sig_weight=np.full(len(variable_array),0,dtype=float)
-    #bkg_weight=np.full(len(variable_array),0,dtype=float)
-
-    #To produce vectors of 0 or 1 for given pt ranges
-    bin_indices0or1=find_bin(variable_array,binning)
-    tmp_i=0 # pt bin index
-    for vec01 in bin_indices0or1:
-        #KM: this line is the most important to calculate the weights for al events
-        for i in range(nClass): class_weight[i] += (vec01 * (train_labels==i) )* weights[i][tmp_i]
-        #sig_weight += (vec01 * (train_labels==0) )* weights[0][tmp_i]
-        #bkg_weight += (vec01 * (train_labels==1) )* weights[1][tmp_i]
-        tmp_i+=1
-        pass
-
-    if debug:
-        print()
-        #print(sig_weight,"\n", bkg_weight)
-        tmp_i=0
-        for i in range(nClass):
-            print("class_weight[",tmp_i,"]=",class_weight[i])
-            tmp_i+=1
-            pass
-        #print("final_weights=",final_weights) #print(final_weights,final_weights.all()==1) # w
-        print("train_labels=",train_labels)
-        pass
-
-    for i in range(nClass): final_weights+=class_weight[i]
-
-    if debug:
-        print("variable_array=",variable_array)
-        print(final_weights, len(final_weights), "any element is zero?",final_weights.any()==0)
-        pass
-
     #KM: below only for plotting
     for i_class in range(nClass):
-        plt.hist(variable[i_class],bins=binning,weights=final_weights[ train_labels==i_class ],label=labels[i_class],histtype='step',facecolor=colors[i_class])
-        #weights = final_weights[ train_labels==i_class ]/len(train_labels)
-        #plt.hist(variable[i_class],bins=binning, weights=weights, label=labels[i_class],histtype='step',facecolor=colors[i_class])
+        plt.hist(variable_array[ train_labels==i_class ],bins=binning,weights=final_weights[ train_labels==i_class ],label=labels[i_class],histtype='step',facecolor=colors[i_class])
         pass
     if nClass>2: plt.yscale("log")
     plt.savefig(output_dir+'/'+ref_var+"_aftReweighting.png")
     plt.clf() #clear plot
-
-    return final_weights